@@ -1,12 +1,33 @@
 import streamlit as st
 
-st.set_page_config(layout="wide")
+from column_profile import set_dataframe
+from dataset_store import open_dataset
+from render_service import get_render_service
 
-pages = [
-    st.Page("upload_modify_df.py", title="Upload/Modify Your Data"),
-    st.Page("hammock_settings.py", title="Hammock Plot Settings"),
-]
+# render workers are spawned processes, which re-run the main script (this file) when
+# they start; the guard keeps them from running the app
+if __name__ == "__main__":
+    st.set_page_config(layout="wide")
 
-pg = st.navigation(pages)
+    # reattach to the stored dataset after a page reload instead of asking for a re-upload
+    if "df" not in st.session_state and "dataset" in st.query_params:
+        df = open_dataset(st.query_params["dataset"])
+        if df is not None:
+            st.session_state.dataset_id = st.query_params["dataset"]
+            set_dataframe(df)
+        else:
+            del st.query_params["dataset"]
+    elif st.session_state.get("dataset_id"):
+        st.query_params["dataset"] = st.session_state.dataset_id
 
-pg.run()
\ No newline at end of file
+    # start the render workers while the user is still picking their data
+    get_render_service()
+
+    pages = [
+        st.Page("upload_modify_df.py", title="Upload/Modify Your Data"),
+        st.Page("hammock_settings.py", title="Hammock Plot Settings"),
+    ]
+
+    pg = st.navigation(pages)
+
+    pg.run()
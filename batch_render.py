@@ -0,0 +1,214 @@
+"""
+Renders hammock plots without the web app, from plot specs saved as JSON.
+
+A spec holds every utils.plot() argument (the "Settings (JSON)" download on the
+settings page saves the plot on screen as one) and optionally a file name, format and
+dpi. A spec file holds one spec or a list of them. The plots are rendered in parallel
+by render worker processes, one per core by default:
+
+    python batch_render.py data.csv specs/ --out-dir plots
+    python batch_render.py data.parquet a.json b.json --format svg --workers 4
+
+or from Python, render_batch(df, specs, "plots").
+"""
+import os
+import re
+import sys
+import json
+import inspect
+import argparse
+from concurrent.futures import as_completed
+
+import numpy as np
+import pandas as pd
+
+SPEC_VERSION = 1
+SPEC_FORMATS = ["png", "svg", "pdf"]
+# spec names become file names in the output directory, so no path separators or dot-dot
+SPEC_NAME = re.compile(r"\w[\w .-]*")
+
+def plot_arguments():
+    """
+    (names of all utils.plot() arguments, names of those without a default).
+    """
+    from utils import plot
+    parameters = inspect.signature(plot).parameters.values()
+    return [p.name for p in parameters], [p.name for p in parameters if p.default is inspect.Parameter.empty]
+
+def plot_spec(settings: dict, name=None, fmt="png", dpi=None) -> dict:
+    """
+    A spec for plotting with settings, the full set of utils.plot() arguments.
+    """
+    spec = {"version": SPEC_VERSION, "format": fmt, "dpi": dpi, "plot": settings}
+    if name:
+        spec["name"] = name
+    return spec
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, pd.Index)):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} can't be saved in a plot spec")
+
+def spec_json(spec) -> str:
+    return json.dumps(spec, indent=1, default=_json_value)
+
+def check_name(name):
+    """
+    Raises ValueError if name can't be used as a plot's file name.
+    """
+    if not isinstance(name, str) or not SPEC_NAME.fullmatch(name) or ".." in name:
+        raise ValueError(f"invalid name {name!r}: use letters, digits, spaces, dots, dashes and underscores, "
+                         f"starting with a letter or digit")
+
+def check_spec(spec, columns, name=None):
+    """
+    Raises ValueError if spec is not a plot spec for data with these columns, or if the
+    name it is saved under (name, else its own) can't be used as a file name.
+    """
+    if not isinstance(spec, dict) or not isinstance(spec.get("plot"), dict):
+        raise ValueError("a spec must be an object with the plot arguments under \"plot\"")
+    name = name if name is not None else spec.get("name")
+    if name is not None:
+        check_name(name)
+    if spec.get("version", SPEC_VERSION) > SPEC_VERSION:
+        raise ValueError(f"spec version {spec['version']} is newer than this app's ({SPEC_VERSION})")
+    if spec.get("format", "png") not in SPEC_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(SPEC_FORMATS)}")
+    names, required = plot_arguments()
+    settings = spec["plot"]
+    unknown = [name for name in settings if name not in names]
+    if unknown:
+        raise ValueError(f"unknown plot arguments: {', '.join(unknown)}")
+    missing = [name for name in required if name not in settings]
+    if missing:
+        raise ValueError(f"missing plot arguments: {', '.join(missing)}")
+    facet = settings.get("facet")
+    if facet and spec.get("format", "png") != "png":
+        raise ValueError("faceted plots can only be saved as PNG")
+    used = list(settings["var"]) + [col for col in [settings["weights"], settings["hi_var"], facet and facet["column"]] if col]
+    absent = [col for col in used if col not in columns]
+    if absent:
+        raise ValueError(f"not in the data: {', '.join(absent)}")
+
+def load_specs(paths) -> list:
+    """
+    (name, spec) for every spec in the given JSON files and directories of JSON files.
+    Specs without a name are named after their file (and position in it).
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json")))
+        else:
+            files.append(path)
+    specs = []
+    for file in files:
+        with open(file) as f:
+            loaded = json.load(f)
+        stem = os.path.splitext(os.path.basename(file))[0]
+        if isinstance(loaded, list):
+            specs.extend((spec.get("name") or f"{stem}-{i + 1}", spec) for i, spec in enumerate(loaded))
+        else:
+            specs.append((loaded.get("name") or stem, loaded))
+    return specs
+
+def read_data(path, compact=True) -> pd.DataFrame:
+    """
+    Reads a CSV, Parquet, Feather or Arrow file as the upload page does.
+    """
+    from data_loading import file_format, read_csv_chunked, columnar_columns, read_columnar, compact_dtypes
+    fmt = file_format(path)
+    with open(path, "rb") as f:
+        df = read_csv_chunked(f) if fmt == "csv" else read_columnar(f, fmt, columnar_columns(f, fmt))
+    return compact_dtypes(df) if compact else df
+
+def render_batch(df: pd.DataFrame, specs, out_dir, workers=None, fmt=None, dpi=None, on_done=None) -> list:
+    """
+    Renders (name, spec) pairs of df to files in out_dir across worker processes. fmt
+    and dpi override the specs'. Calls on_done(result) as each plot finishes, and
+    returns the results in spec order: dicts with the name, the file (None if it
+    failed), the error if any and the render's perf record.
+    """
+    from dataset_store import put_dataset
+    from render_service import worker_pool, batch_task, RENDER_WORKERS
+
+    os.makedirs(out_dir, exist_ok=True)
+    # workers memory-map the data from the dataset store instead of each getting a copy
+    data = put_dataset(df)
+    data = df if data is None else data
+
+    results = []
+    jobs = []
+    used_paths = set()
+    for name, spec in specs:
+        result = {"name": name, "file": None, "error": None, "record": None}
+        results.append(result)
+        try:
+            check_spec(spec, df.columns, name)
+        except ValueError as e:
+            result["error"] = str(e)
+            if on_done:
+                on_done(result)
+            continue
+        ext = fmt or spec.get("format", "png")
+        path = os.path.join(out_dir, f"{name}.{ext}")
+        suffix = 2
+        while path in used_paths:
+            path = os.path.join(out_dir, f"{name}-{suffix}.{ext}")
+            suffix += 1
+        used_paths.add(path)
+        settings = dict(spec["plot"])
+        sample_rows = settings.pop("sample_rows", None)
+        jobs.append((result, path, (data, settings, sample_rows, ext, dpi or spec.get("dpi"), path)))
+
+    if jobs:
+        with worker_pool(min(workers or RENDER_WORKERS, len(jobs))) as pool:
+            futures = {pool.submit(batch_task, *args): (result, path) for result, path, args in jobs}
+            for future in as_completed(futures):
+                result, path = futures[future]
+                try:
+                    result["record"] = future.result()
+                    result["file"] = path
+                except Exception as e:
+                    result["error"] = f"{type(e).__name__}: {e}"
+                if on_done:
+                    on_done(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Render hammock plots from saved plot specs.")
+    parser.add_argument("data", help="CSV, Parquet, Feather or Arrow file")
+    parser.add_argument("specs", nargs="+", help="spec JSON files, or directories of them")
+    parser.add_argument("--out-dir", default="plots")
+    parser.add_argument("--workers", type=int, help="render processes (default: one per core)")
+    parser.add_argument("--format", choices=SPEC_FORMATS, help="save every plot in this format")
+    parser.add_argument("--dpi", type=int, help="PNG resolution for every plot")
+    parser.add_argument("--no-compact", action="store_true", help="keep the data's dtypes as read")
+    parser.add_argument("--report", help="JSON file to write each plot's result and timings to")
+    options = parser.parse_args()
+
+    from perf import log_record
+
+    specs = load_specs(options.specs)
+    df = read_data(options.data, compact=not options.no_compact)
+    print(f"Rendering {len(specs)} plots of {len(df):,} rows", file=sys.stderr)
+
+    def on_done(result):
+        if result["error"]:
+            print(f"FAILED {result['name']}: {result['error']}", file=sys.stderr)
+        else:
+            log_record(dict(result["record"], name=result["name"]), keep=False)
+
+    results = render_batch(df, specs, options.out_dir, options.workers, options.format, options.dpi, on_done)
+    failed = [result for result in results if result["error"]]
+    print(f"{len(results) - len(failed)} plots written to {options.out_dir}, {len(failed)} failed", file=sys.stderr)
+    if options.report:
+        with open(options.report, "w") as f:
+            json.dump(results, f, indent=1, default=str)
+    sys.exit(1 if failed else 0)
+
+# render workers are spawned processes that import this file; only the command runs it
+if __name__ == "__main__":
+    main()
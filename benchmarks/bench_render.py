@@ -0,0 +1,249 @@
+"""
+Benchmarks of the data-prep helpers and plot rendering over synthetic data.
+
+Each case is a make_frame shape. Starting from a base shape, one dimension at a time is
+varied (rows, unibar count, cardinality, missing fraction, numeric fraction), and for
+each case this times:
+
+- profile columns: build_profile, which get_uni_type, unique values and the weight
+  candidates are read from
+- get_uni_type, get_formatted_values (over each unibar's unique values)
+- validate_expression and is_in_range (one call per value), and highlight_mask (the
+  vectorised range test used for highlighting)
+- the render stages of utils.render_plot: prepare data, aggregate, hammock plot and
+  savefig (the PNG export)
+
+Usage, from the repo root:
+
+    python benchmarks/bench_render.py run --output results.json
+    python benchmarks/bench_render.py run --preset full --output baseline.json
+    python benchmarks/bench_render.py run --rows 1000 100000 --baseline baseline.json
+    python benchmarks/bench_render.py compare baseline.json results.json
+
+compare (and run with --baseline) exits with status 1 if any timing got slower by more
+than --tolerance. The full preset takes a while: unibars with thousands of labels are
+plotted unbinned, and each of those renders takes over a minute.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import datetime
+from importlib import metadata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import streamlit as st
+import streamlit.logger
+
+from column_profile import build_profile
+from utils import get_uni_type, get_formatted_values, validate_expression, is_in_range, highlight_mask, render_plot
+from perf import StageTimer
+from synthetic import make_frame, plot_args
+
+BASE_SHAPE = {"rows": 10_000, "unibars": 4, "cardinality": 10, "missing": 0.0, "numeric_fraction": 0.5}
+PRESETS = {
+    "quick": {
+        "rows": [1_000, 10_000, 100_000],
+        "unibars": [2, 4, 8],
+        "cardinality": [5, 10, 100],
+        "missing": [0.0, 0.2],
+        "numeric_fraction": [0.0, 0.5, 1.0],
+    },
+    "full": {
+        "rows": [1_000, 10_000, 100_000, 1_000_000, 10_000_000],
+        "unibars": [2, 4, 8, 16],
+        "cardinality": [5, 10, 100, 1_000, 10_000],
+        "missing": [0.0, 0.05, 0.2, 0.5],
+        "numeric_fraction": [0.0, 0.25, 0.5, 0.75, 1.0],
+    },
+}
+EXPRESSIONS = ["x>50", "x>1 and (x>5 or x<4)", "40<=x<60", "level [0-3]$", "^level 1", "x>", "[unclosed"]
+SCALAR_CALLS = 1_000 # values passed one at a time to is_in_range
+NOISE_FLOOR = 0.005 # seconds; smaller differences are not reported as regressions
+
+def cases(grid):
+    """
+    The shapes to benchmark: the base shape, and the base shape with each value of each
+    dimension in grid, without repeats.
+    """
+    shapes = [dict(BASE_SHAPE)]
+    for dimension, values in grid.items():
+        for value in values:
+            shape = dict(BASE_SHAPE, **{dimension: value})
+            if shape not in shapes:
+                shapes.append(shape)
+    return shapes
+
+def case_name(shape) -> str:
+    return ",".join(f"{dimension}={value}" for dimension, value in shape.items())
+
+def timed(fn, repeat):
+    """
+    Runs fn repeat times, returning (its last result, list of seconds per run).
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+    return result, seconds
+
+def summary(seconds) -> dict:
+    return {"min": round(min(seconds), 6), "median": round(statistics.median(seconds), 6), "runs": len(seconds)}
+
+def bench_case(shape, repeat, render_max_rows) -> dict:
+    df = make_frame(**shape)
+    unibars = [col for col in df.columns if col != "weight"]
+    timings = {}
+
+    profile, seconds = timed(lambda: build_profile(df), repeat)
+    timings["profile columns"] = seconds
+    # get_uni_type and unique values read the session's profile, as they do in the app
+    st.session_state.profile = profile
+    st.session_state.df = df
+
+    _, timings["get_uni_type"] = timed(lambda: [get_uni_type(col) for col in unibars], repeat)
+    uniques = {col: pd.Series(df[col].unique()) for col in unibars}
+    _, timings["get_formatted_values"] = timed(lambda: [get_formatted_values(values) for values in uniques.values()], repeat)
+    _, timings["validate_expression"] = timed(lambda: [validate_expression(expr) for expr in EXPRESSIONS], repeat)
+
+    numeric = [col for col in unibars if col.startswith("num")]
+    hi_var = numeric[0] if numeric else unibars[0]
+    hi_value = "x>50" if numeric else "level [0-3]$"
+    if numeric:
+        values = df[hi_var].to_numpy()[:SCALAR_CALLS]
+        _, timings["is_in_range"] = timed(lambda: [is_in_range(x, hi_value) for x in values], repeat)
+    _, timings["highlight_mask"] = timed(lambda: highlight_mask(df[hi_var], hi_value), repeat)
+
+    counts = {}
+    if render_max_rows is None or len(df) <= render_max_rows:
+        args = plot_args(df, hi_var=hi_var, hi_value=hi_value)
+        for _ in range(repeat):
+            timer = StageTimer("render")
+            start = time.perf_counter()
+            fig, _ = render_plot(df, args, timer=timer)
+            seconds = time.perf_counter() - start
+            plt.close(fig)
+            for stage, stage_seconds in timer.stages.items():
+                timings.setdefault(stage, []).append(stage_seconds)
+            timings.setdefault("render total", []).append(seconds)
+            counts = timer.counts
+
+    return {"case": case_name(shape), "shape": shape,
+            "timings": {name: summary(seconds) for name, seconds in timings.items()},
+            "counts": counts}
+
+def _version(package):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "versions": {package: _version(package) for package in ["numpy", "pandas", "matplotlib", "streamlit", "hammock_plot"]},
+    }
+
+def compare(baseline, results, tolerance) -> list:
+    """
+    Prints each timing of results next to the same timing in baseline (compared on the
+    fastest run) and returns the ones more than tolerance slower.
+    """
+    base = {(case["case"], name): timing["min"] for case in baseline["results"] for name, timing in case["timings"].items()}
+    regressions = []
+    rows = []
+    for case in results["results"]:
+        for name, timing in case["timings"].items():
+            before = base.get((case["case"], name))
+            if before is None:
+                continue
+            after = timing["min"]
+            ratio = after / before if before else float("inf")
+            slower = ratio > 1 + tolerance and after - before > NOISE_FLOOR
+            if slower:
+                regressions.append((case["case"], name, before, after, ratio))
+            rows.append((case["case"], name, before, after, ratio, "SLOWER" if slower else ""))
+    if not rows:
+        print("No cases in common with the baseline")
+        return regressions
+    width = max(len(row[0]) for row in rows)
+    print(f"{'case':<{width}}  {'timing':<22} {'baseline':>10} {'now':>10} {'ratio':>7}")
+    for case, name, before, after, ratio, flag in rows:
+        print(f"{case:<{width}}  {name:<22} {before:>10.4f} {after:>10.4f} {ratio:>7.2f} {flag}")
+    print(f"{len(regressions)} of {len(rows)} timings more than {tolerance:.0%} slower than the baseline")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument("--preset", choices=list(PRESETS), default="quick")
+    for dimension, kind in [("rows", int), ("unibars", int), ("cardinality", int), ("missing", float), ("numeric_fraction", float)]:
+        run.add_argument(f"--{dimension.replace('_', '-')}", dest=dimension, type=kind, nargs="+",
+                         help=f"values of {dimension} to try instead of the preset's")
+    run.add_argument("--repeat", type=int, default=3, help="runs per timing; the fastest is compared")
+    run.add_argument("--render-max-rows", type=int,
+                     help="only render cases with at most this many rows, timing just the helpers for larger ones")
+    run.add_argument("--output", help="JSON file to write the results to")
+    run.add_argument("--baseline", help="results JSON to compare against")
+    run.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed before a timing counts as a regression")
+
+    diff = commands.add_parser("compare", help="compare two results files")
+    diff.add_argument("baseline")
+    diff.add_argument("results")
+    diff.add_argument("--tolerance", type=float, default=0.25)
+    options = parser.parse_args()
+
+    if options.command == "compare":
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        with open(options.results) as f:
+            results = json.load(f)
+        sys.exit(1 if compare(baseline, results, options.tolerance) else 0)
+
+    # the helpers use session state, which works outside `streamlit run` but warns about it
+    streamlit.logger.set_log_level("error")
+    grid = dict(PRESETS[options.preset])
+    for dimension in grid:
+        if getattr(options, dimension) is not None:
+            grid[dimension] = getattr(options, dimension)
+    results = {"environment": environment(), "repeat": options.repeat, "results": []}
+    for shape in cases(grid):
+        start = time.perf_counter()
+        result = bench_case(shape, options.repeat, options.render_max_rows)
+        results["results"].append(result)
+        print(f"{result['case']}: {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=1, default=str)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(baseline, results, options.tolerance) else 0)
+    if not options.output:
+        json.dump(results, sys.stdout, indent=1, default=str)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Load test: many simulated sessions using the app at once, on this machine.
+
+Each session drives app.py with Streamlit's app testing (AppTest) the way an analyst
+would: upload a CSV, open the settings page, select unibars and wait for the plot,
+highlight with an expression, apply and wait again, then download the plot as PNG.
+Sessions share the render service and caches, as sessions on one server do. Each
+uploads its own synthetic data (see synthetic.make_frame), so they don't just hit the
+render cache for each other's plots, unless --same-data is given.
+
+Reported: latency percentiles of the script reruns of each step (what a user waits
+for after clicking), time from requesting a plot to seeing it, renders per second
+(plots shown) across all sessions, and peak resident memory of the server process and its render
+workers together.
+
+    python benchmarks/load_test.py --sessions 8 --rows 20000
+    python benchmarks/load_test.py --sessions 16 --rounds 3 --output load.json --max-rerun-p95 2
+
+With --max-rerun-p95, --max-plot-p95 or --min-throughput it exits with status 1 if the
+run doesn't meet them. Linux only (memory is read from /proc).
+
+Unlike a server, AppTest swaps process-wide runtime state for each script run, so
+scripts of different sessions take turns here (renders and downloads still run
+concurrently). Rerun latencies time the script run alone, and time to plot leaves out
+the turn-taking; the wait for a turn is reported on its own as "harness wait", which
+has no counterpart on a server and grows with the number of sessions. The browser reruns only the plot fragment while waiting
+for a render, whereas AppTest reruns the page; those polls are reported separately.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+POLL_INTERVAL = 0.5 # seconds between reruns while waiting for a render, as in the plot fragment
+RSS_INTERVAL = 0.25 # seconds between memory samples
+PERCENTILES = [50, 90, 95, 99]
+RUN_TIMEOUT = 300 # seconds a single script run may take
+PLOT_TIMEOUT = 900 # seconds to wait for a render
+
+def process_tree_rss_mb(root_pid) -> float:
+    """
+    Resident memory of a process and all of its descendants, in MB.
+    """
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may contain spaces, so split after its closing parenthesis
+                parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    tree = [root_pid]
+    for pid in tree:
+        tree.extend(child for child, parent in parents.items() if parent == pid)
+    total_kb = 0
+    for pid in tree:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+class MemoryMonitor(threading.Thread):
+    """
+    Samples the memory of this process and its render workers until stopped, keeping the peak.
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak_mb = 0.0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_mb = max(self.peak_mb, process_tree_rss_mb(os.getpid()))
+            self.stopped.wait(RSS_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak_mb = max(self.peak_mb, process_tree_rss_mb(os.getpid()))
+
+class SimulatedSession:
+    """
+    One analyst's session. Each step's script runs are timed and kept in self.latencies
+    (step -> seconds per run), and each plot's time from request to display in self.plots.
+    Time spent waiting for other sessions' script runs goes to self.waits instead.
+    """
+    def __init__(self, index, csv_bytes, unibars, hi_var, run_lock, downloads):
+        self.index = index
+        self.csv_bytes = csv_bytes
+        self.unibars = unibars
+        self.hi_var = hi_var
+        self.run_lock = run_lock
+        self.downloads = downloads
+        self.latencies = {}
+        self.plots = []
+        self.errors = []
+        self.records = []
+        self.waits = []
+        self.app = None
+
+    def run_script(self, step):
+        waiting = time.perf_counter()
+        with self.run_lock:
+            start = time.perf_counter()
+            self.waits.append(start - waiting)
+            self.app.run(timeout=RUN_TIMEOUT)
+            self.latencies.setdefault(step, []).append(time.perf_counter() - start)
+        if self.app.exception:
+            raise RuntimeError(f"{step}: {self.app.exception[0].message}")
+
+    def widget(self, kind, label):
+        for element in getattr(self.app, kind):
+            if element.label == label:
+                return element
+        raise LookupError(f"no {kind} labelled {label!r} on the page")
+
+    def wait_for_plot(self, step):
+        """
+        Runs step's script run, which requests a plot, then reruns until the plot is shown.
+        """
+        start = time.perf_counter()
+        waits = len(self.waits)
+        self.run_script(step)
+        while self.app.session_state["render_job"] is not None:
+            if time.perf_counter() - start > PLOT_TIMEOUT:
+                raise TimeoutError(f"{step}: no plot after {PLOT_TIMEOUT}s")
+            time.sleep(POLL_INTERVAL)
+            self.run_script("poll")
+        errors = [element.value for element in self.app.error]
+        if errors:
+            self.errors.append(f"{step}: {errors[0]}")
+        else:
+            # as a user would see it, without this harness's turn-taking
+            self.plots.append(time.perf_counter() - start - sum(self.waits[waits:]))
+
+    def download(self, step):
+        """
+        Clicks the PNG download button, then builds the file as the server does when
+        the browser asks for it.
+        """
+        self.widget("download_button", "Download as PNG").click()
+        self.run_script(step)
+        make = self.downloads.pop(self.index, None)
+        if make is None:
+            raise LookupError(f"{step}: the download button has no file")
+        start = time.perf_counter()
+        data = make()
+        self.latencies.setdefault("build download", []).append(time.perf_counter() - start)
+        if not data:
+            self.errors.append(f"{step}: empty download")
+
+    def run(self, rounds):
+        from streamlit.testing.v1 import AppTest
+
+        self.app = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT)
+        self.app.session_state["load_test_session"] = self.index
+        self.run_script("open app")
+
+        self.app.file_uploader[0].set_value((f"session{self.index}.csv", self.csv_bytes, "text/csv"))
+        self.run_script("upload")
+
+        self.app.switch_page("hammock_settings.py")
+        self.run_script("open settings")
+
+        self.widget("multiselect", "Which variables do you want to plot?").set_value(self.unibars)
+        self.wait_for_plot("select unibars")
+
+        self.widget("checkbox", "Enable highlighting?").check()
+        self.run_script("highlight")
+        self.widget("selectbox", "Select the variable to highlight").set_value(self.hi_var)
+        self.run_script("highlight")
+        self.widget("radio", "Highlight type").set_value("expression")
+        self.run_script("highlight")
+        for round in range(rounds):
+            # a different expression each round, so each apply draws a new plot
+            self.widget("text_input", "Expression (regex/range) to highlight").input(f"x>{40 + round}")
+            self.run_script("highlight")
+            self.widget("button", "**Apply Custom Settings**").click()
+            self.wait_for_plot("apply")
+            self.download("download")
+
+        self.records = list(self.app.session_state["perf_records"])
+
+def capture_downloads(downloads: dict):
+    """
+    Keeps the data callable of each session's latest deferred download, keyed by the
+    session's load_test_session index, so the harness can make the file like the
+    server's download handler would.
+    """
+    import streamlit as st
+    from streamlit.runtime.media_file_manager import MediaFileManager
+
+    add_deferred = MediaFileManager.add_deferred
+    def add_and_keep(self, data_callable, *args, **kwargs):
+        index = st.session_state.get("load_test_session")
+        if index is not None:
+            downloads[index] = data_callable
+        return add_deferred(self, data_callable, *args, **kwargs)
+    MediaFileManager.add_deferred = add_and_keep
+
+def percentiles(values) -> dict:
+    import numpy as np
+    if not values:
+        return {}
+    return {f"p{p}": round(float(np.percentile(values, p)), 4) for p in PERCENTILES} | {"count": len(values)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions")
+    parser.add_argument("--rounds", type=int, default=1, help="highlight, apply and download rounds per session")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="seconds over which the sessions start")
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--unibars", type=int, default=4)
+    parser.add_argument("--cardinality", type=int, default=10)
+    parser.add_argument("--same-data", action="store_true", help="upload the same data in every session")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--max-rerun-p95", type=float, help="fail if the p95 rerun latency (seconds) is above this")
+    parser.add_argument("--max-plot-p95", type=float, help="fail if the p95 time to plot (seconds) is above this")
+    parser.add_argument("--min-throughput", type=float, help="fail if fewer plots than this are shown per second")
+    options = parser.parse_args()
+
+    # keep the test's datasets out of the app's store, and its timing log lines out of
+    # the output (they are summarised below instead); render workers inherit both
+    os.environ.setdefault("HAMMOCK_STORE_DIR", tempfile.mkdtemp(prefix="hammock_load_test_"))
+    os.environ.setdefault("HAMMOCK_LOG_LEVEL", "WARNING")
+    import streamlit.logger
+    from streamlit import config
+    from synthetic import make_frame
+    from render_service import get_render_service, RENDER_WORKERS
+
+    config.set_option("logger.level", "error")
+    streamlit.logger.set_log_level("error")
+
+    datasets = {}
+    for index in range(options.sessions):
+        seed = 0 if options.same_data else index
+        if seed not in datasets:
+            df = make_frame(options.rows, options.unibars, options.cardinality, seed=seed)
+            buf = io.BytesIO()
+            df.to_csv(buf, index=False)
+            datasets[seed] = (buf.getvalue(), [col for col in df.columns if col != "weight"])
+
+    downloads = {}
+    capture_downloads(downloads)
+    run_lock = threading.Lock()
+    sessions = []
+    for index in range(options.sessions):
+        csv_bytes, unibars = datasets[0 if options.same_data else index]
+        hi_var = next((col for col in unibars if col.startswith("num")), unibars[0])
+        sessions.append(SimulatedSession(index, csv_bytes, unibars, hi_var, run_lock, downloads))
+
+    get_render_service() # start the workers before the clock does
+    monitor = MemoryMonitor()
+    monitor.start()
+
+    def run_session(session, delay):
+        time.sleep(delay)
+        try:
+            session.run(options.rounds)
+        except Exception as e:
+            session.errors.append(f"{type(e).__name__}: {e}")
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_session, args=(session, options.ramp_up * index / max(options.sessions - 1, 1)))
+               for index, session in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    monitor.stop()
+
+    steps = {}
+    for session in sessions:
+        for step, seconds in session.latencies.items():
+            steps.setdefault(step, []).extend(seconds)
+    reruns = [seconds for step, values in steps.items() if step not in ("poll", "build download") for seconds in values]
+    plots = [seconds for session in sessions for seconds in session.plots]
+    renders = [record["total"] for session in sessions for record in session.records if record["job"] in ("render", "restyle")]
+    waits = [seconds for session in sessions for seconds in session.waits]
+    errors = [f"session {session.index}: {error}" for session in sessions for error in session.errors]
+    results = {
+        "settings": vars(options) | {"render_workers": RENDER_WORKERS},
+        "elapsed": round(elapsed, 2),
+        "rerun_latency": percentiles(reruns),
+        "steps": {step: percentiles(values) for step, values in steps.items()},
+        "time_to_plot": percentiles(plots),
+        "harness_wait": percentiles(waits), # for other sessions' script runs; not part of the latencies
+        "render_time": percentiles(renders), # in the worker, without waiting for one
+        "plots": len(plots),
+        "plots_per_second": round(len(plots) / elapsed, 3),
+        "renders": len(renders), # plots drawn by a worker, not found in the render cache
+        "peak_rss_mb": round(monitor.peak_mb, 1),
+        "errors": errors,
+    }
+
+    print(f"{options.sessions} sessions, {RENDER_WORKERS} render workers, {elapsed:.1f}s")
+    print(f"{'':<18} {'p50':>8} {'p90':>8} {'p95':>8} {'p99':>8} {'count':>6}")
+    for name, summary in [("rerun latency", results["rerun_latency"])] + list(results["steps"].items()) + \
+                         [("time to plot", results["time_to_plot"]), ("render (worker)", results["render_time"]),
+                          ("harness wait", results["harness_wait"])]:
+        if summary:
+            print(f"{name:<18} " + " ".join(f"{summary[f'p{p}']:>8.3f}" for p in PERCENTILES) + f" {summary['count']:>6}")
+    print(f"{results['plots']} plots ({results['renders']} rendered), {results['plots_per_second']:.3f} per second, "
+          f"peak RSS {results['peak_rss_mb']:,.0f} MB")
+    for error in errors:
+        print(error)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    failed = bool(errors)
+    if options.max_rerun_p95 is not None and results["rerun_latency"].get("p95", 0) > options.max_rerun_p95:
+        print(f"FAIL: p95 rerun latency above {options.max_rerun_p95}s")
+        failed = True
+    if options.max_plot_p95 is not None and results["time_to_plot"].get("p95", float("inf")) > options.max_plot_p95:
+        print(f"FAIL: p95 time to plot above {options.max_plot_p95}s")
+        failed = True
+    if options.min_throughput is not None and results["plots_per_second"] < options.min_throughput:
+        print(f"FAIL: fewer than {options.min_throughput} plots per second")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+# render workers are spawned processes that import this file; only the test's own process runs it
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+# Synthetic data for the benchmarks, shaped like data after loading (with compacted
+# dtypes): categorical unibars are pandas categoricals, numeric ones floats with a set
+# number of distinct values.
+
+def make_frame(rows, unibars, cardinality, missing=0.0, numeric_fraction=0.5, seed=0) -> pd.DataFrame:
+    """
+    rows x unibars frame plus a positive "weight" column. round(unibars * numeric_fraction)
+    of the unibars are numeric ("num0", "num1", ...), the rest categorical ("cat0", ...).
+    Each unibar has cardinality distinct values, drawn with a skew so some are rare,
+    and a missing fraction of its values missing.
+    """
+    rng = np.random.default_rng(seed)
+    n_numeric = round(unibars * numeric_fraction)
+    # zipf-like frequencies: the first values are common, the last ones rare
+    freqs = 1 / np.arange(1, cardinality + 1)
+    freqs /= freqs.sum()
+    columns = {}
+    for i in range(unibars):
+        codes = rng.choice(cardinality, size=rows, p=freqs)
+        if missing:
+            codes[rng.random(rows) < missing] = -1
+        if i < n_numeric:
+            levels = np.round(np.sort(rng.normal(50, 15, cardinality)), 2)
+            values = levels[codes]
+            values[codes == -1] = np.nan
+            columns[f"num{i}"] = values
+        else:
+            labels = [f"level {j}" for j in range(cardinality)]
+            columns[f"cat{i - n_numeric}"] = pd.Categorical.from_codes(codes, categories=labels)
+    columns["weight"] = rng.uniform(0.5, 2.0, rows).astype("float32")
+    return pd.DataFrame(columns)
+
+def plot_args(df: pd.DataFrame, hi_var=None, hi_value=None) -> dict:
+    """
+    utils.plot() arguments (without sample_rows) for plotting every unibar of a
+    make_frame frame with the app's default settings.
+    """
+    unibars = [col for col in df.columns if col != "weight"]
+    missing = bool(df[unibars].isna().any().any())
+    return {
+        "var": unibars,
+        "weights": None,
+        "value_order": {},
+        "numerical_var_levels": {},
+        # numeric unibars default to box plots, as in the settings page
+        "display_type": {col: "box" for col in unibars if col.startswith("num")},
+        "missing": missing,
+        "missing_placeholder": "missing" if missing else None,
+        "label": True,
+        "unibar": True,
+        "hi_var": hi_var,
+        "hi_value": hi_value,
+        "hi_box": "side-by-side" if hi_var else None,
+        "hi_missing": False,
+        "colors": ["#fdc086"] if hi_var else [],
+        "default_color": "#beaed4",
+        "uni_vfill": 0.08,
+        "connector_fraction": 1.0,
+        "connector_color": None,
+        "uni_hfill": 0.30,
+        "label_options": {},
+        "height": 10.0,
+        "width": 15.0,
+        "min_bar_height": 0.15,
+        "alpha": 0.7,
+        "shape": "rectangle",
+        "same_scale": [],
+        "violin_bw_method": "scott",
+        "binning": None,
+        "large_n": True,
+        "facet": None,
+    }
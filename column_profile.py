@@ -0,0 +1,151 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+
+MAX_EXACT_UNIQUES = 1000 # columns with more distinct values only keep sketches
+TOP_K = 200 # number of most frequent values kept for high-cardinality columns
+SKETCH_SIZE = 1024 # hashes kept by the distinct-count sketch
+CHUNK_SIZE = 1_000_000 # rows scanned at a time when profiling a column
+
+class DistinctSketch:
+    """
+    K-minimum-values sketch of the number of distinct values in a column. Keeps the
+    SKETCH_SIZE smallest 64-bit hashes seen; the count is exact while fewer distinct
+    values than that have been seen, and estimated from the k-th smallest hash after.
+    """
+    def __init__(self, k=SKETCH_SIZE):
+        self.k = k
+        self.hashes = np.array([], dtype=np.uint64)
+
+    def update(self, values: pd.Index):
+        """
+        Adds a batch of distinct values.
+        """
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+        if len(self.hashes) == self.k:
+            hashes = hashes[hashes < self.hashes[-1]]
+        if len(hashes) > self.k:
+            hashes = np.partition(hashes, self.k)[:self.k]
+        self.hashes = np.unique(np.concatenate([self.hashes, hashes]))[:self.k]
+
+    def estimate(self) -> int:
+        if len(self.hashes) < self.k:
+            return len(self.hashes)
+        return int((self.k - 1) / (float(self.hashes[-1]) / 2.0**64))
+
+class ColumnProfile:
+    """
+    Everything the pages need to know about one column, computed in a single chunked
+    scan: the kind of unibar it makes, null count, distinct values, whether it can be a
+    weight variable and its min/max if numeric.
+
+    Unique values are kept exactly (in order of appearance, like Series.unique) up to
+    max_exact of them. Past that, unique_values is None and only an approximate distinct
+    count and the TOP_K most frequent values are kept, so an ID or free-text column
+    doesn't keep a near-copy of itself in the session.
+    """
+    def __init__(self, column: pd.Series, max_exact=MAX_EXACT_UNIQUES):
+        dtype = column.dtype
+        self.dtype = dtype
+        if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_float_dtype(dtype):
+            self.kind = "numeric"
+        elif pd.api.types.is_categorical_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            self.kind = "categorical"
+        else:
+            self.kind = None # can't be plotted, get_uni_type raises if it's selected
+
+        self.null_count = int(column.isna().sum())
+
+        exact = pd.Index([], dtype=dtype)
+        sketch = DistinctSketch()
+        counts = pd.Series([], dtype="int64")
+        for start in range(0, max(len(column), 1), CHUNK_SIZE):
+            chunk = column.iloc[start:start + CHUNK_SIZE]
+            if exact is not None:
+                uniques = pd.Index(chunk.unique())
+                exact = exact.append(uniques[~uniques.isin(exact)])
+                if len(exact) > max_exact:
+                    exact = None
+            chunk_counts = chunk.value_counts(dropna=True, sort=False)
+            sketch.update(chunk_counts.index)
+            # only the heaviest candidates are carried between chunks, so the top values are approximate
+            chunk_counts = chunk_counts.nlargest(TOP_K * 10)
+            counts = counts.add(chunk_counts, fill_value=0).nlargest(TOP_K * 10)
+
+        self.unique_values = exact.to_numpy() if exact is not None else None
+        self.n_unique_exact = exact is not None
+        self.n_unique = int(exact.notna().sum()) if exact is not None else sketch.estimate()
+        self.top_values = counts.nlargest(TOP_K).astype("int64") if exact is None else None
+
+        self.min = None
+        self.max = None
+        self.weight_eligible = False
+        if pd.api.types.is_numeric_dtype(dtype):
+            if self.null_count < len(column):
+                self.min = column.min()
+                self.max = column.max()
+            self.weight_eligible = self.null_count == 0 and not (column <= 0).any()
+
+    def describe_uniques(self) -> str:
+        if self.n_unique_exact:
+            return f"{self.n_unique} distinct values"
+        return f"~{self.n_unique:,} distinct values"
+
+def build_profile(df: pd.DataFrame) -> dict:
+    return {col: ColumnProfile(df[col]) for col in df.columns}
+
+def set_dataframe(df: pd.DataFrame):
+    """
+    Stores a newly loaded dataframe and profiles all of its columns.
+    """
+    st.session_state.df = df
+    st.session_state.profile = build_profile(df)
+    st.session_state.data_version = st.session_state.get("data_version", 0) + 1
+
+def update_dataframe(df: pd.DataFrame, changed=(), renamed=None):
+    """
+    Stores an edited dataframe. Only the columns in `changed` are profiled again;
+    profiles of renamed columns ({old: new}) are moved over as they are.
+    """
+    profile = dict(st.session_state.profile)
+    for old, new in (renamed or {}).items():
+        profile[new] = profile.pop(old)
+    for col in changed:
+        profile[col] = ColumnProfile(df[col])
+    # keep the profile in the same column order as the data
+    st.session_state.profile = {col: profile[col] for col in df.columns}
+    st.session_state.df = df
+    st.session_state.data_version = st.session_state.get("data_version", 0) + 1
+
+def restore_dataframe(df: pd.DataFrame, profile: dict):
+    """
+    Stores an earlier version of the data along with the profile it had then.
+    """
+    st.session_state.profile = profile
+    st.session_state.df = df
+    st.session_state.data_version = st.session_state.get("data_version", 0) + 1
+
+def clear_dataframe():
+    for key in ["df", "profile", "memory_report", "edit_log"]:
+        if key in st.session_state:
+            del st.session_state[key]
+    st.session_state.data_version = st.session_state.get("data_version", 0) + 1
+
+def get_profile(col) -> ColumnProfile:
+    return st.session_state.profile[col]
+
+def unique_values(col):
+    """
+    All unique values of a column. Comes from the profile when it kept them; otherwise
+    the column is scanned again, and the result is not stored.
+    """
+    profile = get_profile(col)
+    if profile.unique_values is not None:
+        return profile.unique_values
+    return st.session_state.df[col].unique()
+
+def weight_candidates() -> list:
+    """
+    Columns that can be used as a weight variable: numeric, no missing values and all positive.
+    """
+    return [col for col, profile in st.session_state.profile.items() if profile.weight_eligible]
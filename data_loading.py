@@ -0,0 +1,188 @@
+import os
+import pandas as pd
+
+CSV_CHUNK_ROWS = 250_000
+CSV_SAMPLE_ROWS = 10_000
+
+COLUMNAR_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "arrow",
+    ".arrows": "arrow",
+    ".ipc": "arrow",
+}
+UPLOAD_TYPES = ["csv"] + [ext.lstrip(".") for ext in COLUMNAR_FORMATS]
+
+def file_format(file_name: str) -> str:
+    ext = os.path.splitext(file_name)[1].lower()
+    return COLUMNAR_FORMATS.get(ext, "csv")
+
+def infer_csv_dtypes(file, sample_rows=CSV_SAMPLE_ROWS) -> dict:
+    """
+    Reads the first sample_rows of a CSV to fix the dtype of its float and string
+    columns up front, so the chunks don't each infer them again. Integer and other
+    columns are left to per-chunk inference (a missing value later on turns ints into floats).
+    """
+    file.seek(0)
+    sample = pd.read_csv(file, nrows=sample_rows)
+    file.seek(0)
+    dtypes = {}
+    for col, dtype in sample.dtypes.items():
+        if pd.api.types.is_float_dtype(dtype):
+            dtypes[col] = "float64"
+        elif pd.api.types.is_string_dtype(dtype) and not sample[col].isna().all():
+            dtypes[col] = dtype
+    return dtypes
+
+def read_csv_chunked(file, on_progress=None, chunk_rows=CSV_CHUNK_ROWS) -> pd.DataFrame:
+    """
+    Parses a CSV in chunks of chunk_rows, calling on_progress(fraction) after each one.
+    Returns the same frame as a single pd.read_csv, except that a column mixing numbers
+    and text (e.g. numbers in the first chunks, text later) is read again as strings,
+    rather than being left as a mix of Python ints and strs.
+    """
+    size = getattr(file, "size", None)
+    dtypes = infer_csv_dtypes(file)
+    try:
+        chunks = _read_chunks(file, dtypes, chunk_rows, size, on_progress)
+    except ValueError:
+        # a column that looked like floats in the sample has text further down
+        dtypes = {col: dtype for col, dtype in dtypes.items() if dtype != "float64"}
+        chunks = _read_chunks(file, dtypes, chunk_rows, size, on_progress)
+
+    if not chunks:
+        file.seek(0)
+        return pd.read_csv(file)
+
+    df = pd.concat(chunks, ignore_index=True)
+    mixed = []
+    for col in df.columns:
+        kinds = {"numeric" if pd.api.types.is_numeric_dtype(chunk[col].dtype) and not pd.api.types.is_bool_dtype(chunk[col].dtype)
+                 else str(chunk[col].dtype) for chunk in chunks}
+        if len(kinds) > 1:
+            mixed.append(col)
+    if mixed:
+        file.seek(0)
+        reread = pd.read_csv(file, usecols=mixed, dtype={col: str for col in mixed})
+        for col in mixed:
+            df[col] = reread[col]
+    if on_progress is not None:
+        on_progress(1.0)
+    return df
+
+def _read_chunks(file, dtypes, chunk_rows, size, on_progress):
+    file.seek(0)
+    chunks = []
+    for chunk in pd.read_csv(file, dtype=dtypes, chunksize=chunk_rows):
+        chunks.append(chunk)
+        if on_progress is not None and size:
+            on_progress(min(file.tell() / size, 1.0))
+    return chunks
+
+def columnar_columns(file, fmt) -> list:
+    """
+    Column names of a Parquet/Feather/Arrow file, read from its schema only.
+    """
+    file.seek(0)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        names = pq.ParquetFile(file).schema_arrow.names
+    else:
+        names = _open_arrow(file).schema.names
+    file.seek(0)
+    return names
+
+def read_columnar(file, fmt, columns) -> pd.DataFrame:
+    """
+    Reads only the given columns of a Parquet/Feather/Arrow file.
+    """
+    import pyarrow as pa
+    file.seek(0)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        table = pq.read_table(file, columns=columns)
+    else:
+        reader = _open_arrow(file)
+        if isinstance(reader, pa.ipc.RecordBatchFileReader):
+            table = pa.Table.from_batches(
+                [reader.get_batch(i).select(columns) for i in range(reader.num_record_batches)],
+                schema=pa.schema([reader.schema.field(col) for col in columns]))
+        else:
+            table = pa.Table.from_batches([batch.select(columns) for batch in reader],
+                                          schema=pa.schema([reader.schema.field(col) for col in columns]))
+    file.seek(0)
+    return table.to_pandas()
+
+def _open_arrow(file):
+    """
+    Feather v2 and .arrow files use the Arrow IPC file format; .arrows holds an IPC stream.
+    """
+    import pyarrow as pa
+    file.seek(0)
+    try:
+        return pa.ipc.open_file(file)
+    except pa.ArrowInvalid:
+        file.seek(0)
+        return pa.ipc.open_stream(file)
+
+CATEGORY_MAX_RATIO = 0.5 # strings become categories if at most this fraction of values are distinct
+
+def _arrow_string_dtype():
+    """
+    Arrow-backed string dtype with NaN as the missing value (the default "str" dtype in
+    pandas 3), or None if this pandas/pyarrow can't provide it.
+    """
+    try:
+        import numpy as np
+        return pd.StringDtype("pyarrow", na_value=np.nan)
+    except (TypeError, ImportError):
+        try:
+            return pd.StringDtype("pyarrow_numpy")
+        except (TypeError, ImportError):
+            return None
+
+def compact_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns df with smaller dtypes that hold exactly the same values:
+      - string columns with few distinct values become categories
+      - other string columns become Arrow-backed strings
+      - integers are downcast to the smallest integer type that fits
+      - floats become float32 when every value survives the round trip
+    """
+    compacted = {}
+    string_dtype = _arrow_string_dtype()
+    for col in df.columns:
+        column = df[col]
+        dtype = column.dtype
+        if pd.api.types.is_bool_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype):
+            compacted[col] = pd.to_numeric(column, downcast="integer")
+        elif pd.api.types.is_float_dtype(dtype):
+            narrow = column.astype("float32")
+            if narrow.astype(dtype).equals(column):
+                compacted[col] = narrow
+        elif pd.api.types.is_string_dtype(dtype) and pd.api.types.infer_dtype(column, skipna=True) in ("string", "empty"):
+            if column.nunique(dropna=True) <= len(column) * CATEGORY_MAX_RATIO:
+                compacted[col] = column.astype("category")
+            elif string_dtype is not None and dtype != string_dtype:
+                compacted[col] = column.astype(string_dtype)
+    if not compacted:
+        return df
+    return df.assign(**compacted)
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame) -> pd.DataFrame:
+    """
+    Per-column dtype and memory (MB) before and after compaction, with a total row.
+    """
+    before_mb = before.memory_usage(deep=True, index=False) / 1e6
+    after_mb = after.memory_usage(deep=True, index=False) / 1e6
+    report = pd.DataFrame({
+        "dtype before": before.dtypes.astype(str),
+        "dtype after": after.dtypes.astype(str),
+        "MB before": before_mb,
+        "MB after": after_mb,
+    })
+    report.loc["total"] = ["", "", before_mb.sum(), after_mb.sum()]
+    return report
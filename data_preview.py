@@ -0,0 +1,84 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+
+from utils import validate_expression, highlight_mask
+
+# The preview only sends the rows on the current page to the browser. Sorting, filtering
+# and sampling happen here, giving the row positions to page through, which are kept
+# for the session until the data or the preview's settings change.
+PAGE_SIZES = [25, 100, 500]
+PREVIEW_SAMPLE_ROWS = 1000
+NO_COLUMN = "(none)"
+
+def preview_positions(df: pd.DataFrame, sort_by=None, descending=False, filter_col=None, filter_expr="", sample_rows=None):
+    """
+    Positions of the rows to preview: those matching filter_expr (a regex/range
+    expression, as for highlighting) in filter_col, then a random sample of sample_rows
+    of them, sorted by sort_by with missing values last. Returns (positions, number of
+    matching rows).
+    """
+    positions = np.arange(len(df))
+    if filter_col is not None and filter_expr:
+        positions = np.flatnonzero(highlight_mask(df[filter_col], filter_expr))
+    matching = len(positions)
+    if sample_rows is not None and len(positions) > sample_rows:
+        rng = np.random.default_rng(0)
+        positions = np.sort(rng.choice(positions, sample_rows, replace=False))
+    if sort_by is not None:
+        column = df[sort_by].iloc[positions].reset_index(drop=True)
+        order = column.sort_values(ascending=not descending, kind="stable", na_position="last").index.to_numpy()
+        positions = positions[order]
+    return positions, matching
+
+@st.fragment
+def data_preview(key, hide_index=False):
+    """
+    Paged view of st.session_state.df with sorting, filtering and a sampled view. Runs
+    as a fragment, so paging through it doesn't rerun the rest of the page.
+    """
+    df = st.session_state.df
+    columns = [NO_COLUMN] + list(df.columns)
+
+    with st.popover("Sort, filter & sample"):
+        sort_by = st.selectbox(label="Sort by", options=columns, key=f"{key}_sort")
+        descending = st.toggle(label="Descending", key=f"{key}_descending", disabled=sort_by == NO_COLUMN)
+        filter_col = st.selectbox(label="Filter column", options=columns, key=f"{key}_filter_col")
+        filter_expr = ""
+        if filter_col != NO_COLUMN:
+            filter_expr = st.text_input(label="Keep rows matching (regex/range)", key=f"{key}_filter",
+                                        help="e.g. x>1 and (x>5 or x<4)")
+            if filter_expr and not validate_expression(filter_expr):
+                st.error("Must provide a valid expression (regex/range)")
+                filter_expr = ""
+        sample = st.checkbox(label=f"Random sample of {PREVIEW_SAMPLE_ROWS:,} rows", key=f"{key}_sample")
+
+    settings = (st.session_state.get("data_version", 0), sort_by, descending, filter_col, filter_expr, sample)
+    cached = st.session_state.get(f"{key}_positions")
+    if cached is None or cached[0] != settings:
+        positions, matching = preview_positions(df,
+                                                sort_by=None if sort_by == NO_COLUMN else sort_by,
+                                                descending=descending,
+                                                filter_col=None if filter_col == NO_COLUMN else filter_col,
+                                                filter_expr=filter_expr,
+                                                sample_rows=PREVIEW_SAMPLE_ROWS if sample else None)
+        cached = (settings, positions, matching)
+        st.session_state[f"{key}_positions"] = cached
+        st.session_state.pop(f"{key}_page", None) # back to the first page
+    _, positions, matching = cached
+
+    summary = f"{len(df):,} rows × {len(df.columns):,} columns"
+    if filter_expr:
+        summary += f" · {matching:,} matching"
+    if len(positions) < matching:
+        summary += f" · showing a random sample of {len(positions):,}"
+    st.caption(summary)
+
+    subcol1, subcol2 = st.columns([1, 1])
+    page_size = subcol2.selectbox(label="Rows per page", options=PAGE_SIZES, key=f"{key}_page_size")
+    num_pages = max(1, -(-len(positions) // page_size))
+    if st.session_state.get(f"{key}_page", 1) > num_pages:
+        st.session_state.pop(f"{key}_page")
+    page = subcol1.number_input(label=f"Page (of {num_pages:,})", min_value=1, max_value=num_pages, value=1, step=1, key=f"{key}_page")
+
+    st.dataframe(df.iloc[positions[(page - 1) * page_size:page * page_size]], hide_index=hide_index)
@@ -0,0 +1,174 @@
+import os
+import re
+import json
+import hashlib
+import streamlit as st
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+
+from utils import fingerprint_df
+
+# Uploads are written once, keyed by content hash, to an uncompressed Arrow IPC
+# (Feather v2) file that every session memory-maps. Edits are stored as small JSON
+# manifests - the base dataset plus the list of edits - instead of new copies.
+STORE_DIR = os.environ.get("HAMMOCK_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".hammock_store"))
+SHARED_DATASETS = 16 # distinct datasets kept open in memory at once
+
+if int(pd.__version__.split(".")[0]) < 3:
+    # sessions share the memory-mapped frame; copy-on-write (always on from pandas 3)
+    # makes edits copy only the columns they touch instead of writing into shared memory
+    pd.options.mode.copy_on_write = True
+
+# ids the store hands out: an upload's content hash, or "d" and a manifest's hash for edits
+DATASET_ID = re.compile(r"[0-9a-f]{32}|d[0-9a-f]{31}")
+
+def is_dataset_id(dataset_id) -> bool:
+    return isinstance(dataset_id, str) and DATASET_ID.fullmatch(dataset_id) is not None
+
+def _path(dataset_id, ext):
+    # ids come from query parameters and manifests, so never let one point outside the store
+    if not is_dataset_id(dataset_id):
+        raise ValueError(f"Not a dataset id: {dataset_id!r}")
+    return os.path.join(STORE_DIR, f"{dataset_id}.{ext}")
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    arrays = []
+    for col in df.columns:
+        column = df[col]
+        if isinstance(column.dtype, np.dtype) and column.dtype.kind == "f":
+            # keep NaN as a value rather than a null, so the column maps back without a copy
+            arrays.append(pa.array(column.to_numpy()))
+        else:
+            arrays.append(pa.Array.from_pandas(column))
+    return pa.Table.from_arrays(arrays, names=[str(col) for col in df.columns])
+
+def put_dataset(df: pd.DataFrame):
+    """
+    Writes df to the store if it isn't there already and returns its id, or None if the
+    frame can't be stored as Arrow (e.g. a column mixing numbers and text).
+    """
+    if not all(isinstance(col, str) for col in df.columns):
+        return None
+    dataset_id = fingerprint_df(df)[:32]
+    path = _path(dataset_id, "arrow")
+    if os.path.exists(path):
+        return dataset_id
+    try:
+        table = _to_arrow(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        return None
+    os.makedirs(STORE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path) # atomic, so other sessions never see a half-written file
+    return dataset_id
+
+@st.cache_resource(max_entries=SHARED_DATASETS, show_spinner=False)
+def _open_shared(dataset_id) -> pd.DataFrame:
+    """
+    The one in-memory frame for a stored dataset, shared by every session. Its buffers
+    are memory-mapped from the store file, so they live in the OS page cache.
+    """
+    source = pa.memory_map(_path(dataset_id, "arrow"), "r")
+    table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True)
+
+def _read_manifest(dataset_id):
+    path = _path(dataset_id, "json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def derive_dataset(parent_id, op) -> str:
+    """
+    Records a version of parent_id with one more edit applied and returns its id.
+    Only the base dataset id and the list of edits are written.
+    """
+    parent = _read_manifest(parent_id)
+    manifest = {"base": parent["base"], "ops": parent["ops"] + [op]} if parent else {"base": parent_id, "ops": [op]}
+    encoded = json.dumps(manifest, sort_keys=True)
+    dataset_id = "d" + hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:31]
+    path = _path(dataset_id, "json")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(encoded)
+        os.replace(tmp_path, path)
+    return dataset_id
+
+def open_dataset(dataset_id):
+    """
+    A session's own handle on a stored dataset: a shallow copy of the shared frame
+    (so adding or replacing columns never affects other sessions) with any recorded
+    edits applied. Returns None if the id isn't in the store, or isn't a dataset id at all.
+    """
+    if not is_dataset_id(dataset_id):
+        return None
+    manifest = _read_manifest(dataset_id)
+    base_id = manifest["base"] if manifest else dataset_id
+    if not is_dataset_id(base_id) or not os.path.exists(_path(base_id, "arrow")):
+        return None
+    df = _open_shared(base_id).copy(deep=False)
+    for op in (manifest["ops"] if manifest else []):
+        df = apply_op(df, op)
+    return df
+
+def _json_value(value):
+    """
+    Plain Python value for numpy scalars, so edits can be written as JSON.
+    """
+    return value.item() if hasattr(value, "item") else value
+
+def rename_op(column, new_name) -> dict:
+    return {"op": "rename", "column": column, "to": new_name}
+
+def replace_op(column, old, new) -> dict:
+    return {"op": "replace", "column": column, "old": _json_value(old), "new": _json_value(new)}
+
+def describe_op(op) -> str:
+    if op["op"] == "rename":
+        return f"renaming {op['column']} to {op['to']}"
+    return f"replacing {op['old']} with {op['new']} in {op['column']}"
+
+def apply_op(df: pd.DataFrame, op) -> pd.DataFrame:
+    """
+    Returns df with one edit applied. df itself is left as it is, and only the edited
+    column is copied.
+    """
+    df = df.copy(deep=False)
+    if op["op"] == "rename":
+        df.columns = [op["to"] if col == op["column"] else col for col in df.columns]
+    elif op["op"] == "replace":
+        column = df[op["column"]]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # compacted string column: replace on the plain values, then compact again
+            df[op["column"]] = column.astype(column.cat.categories.dtype).replace(op["old"], op["new"]).astype("category")
+        else:
+            df[op["column"]] = column.replace(op["old"], op["new"])
+    else:
+        raise ValueError(f"Unknown edit: {op['op']}")
+    return df
+
+def op_effect(op) -> dict:
+    """
+    The columns an edit changes, as update_dataframe arguments: columns whose values
+    changed, and renamed columns.
+    """
+    if op["op"] == "rename":
+        return {"renamed": {op["column"]: op["to"]}}
+    return {"changed": [op["column"]]}
+
+def record_op(op):
+    """
+    Points the session at a derived version that includes op, so a reload gets the
+    edited data back.
+    """
+    dataset_id = st.session_state.get("dataset_id")
+    if dataset_id is None:
+        return
+    st.session_state.dataset_id = derive_dataset(dataset_id, op)
+    st.query_params["dataset"] = st.session_state.dataset_id
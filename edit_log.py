@@ -0,0 +1,103 @@
+import streamlit as st
+
+from column_profile import update_dataframe, restore_dataframe
+from dataset_store import apply_op, op_effect, record_op
+
+KEPT_VERSIONS = 10 # versions of the data kept in memory for undo/redo, besides the loaded one
+
+class EditLog:
+    """
+    The session's data edits, in order, with undo and redo. Each version of the data is
+    the one before with one edit applied - a shallow copy sharing every column but the
+    edited one - together with its column profile and dataset store id. The loaded data
+    and the KEPT_VERSIONS most recently visited versions are kept; going back to any
+    other version replays the edits from the nearest kept one before it.
+    """
+    def __init__(self, df, profile, dataset_id):
+        self.ops = []
+        self.dataset_ids = [dataset_id]
+        self.position = 0 # number of edits applied to the current data
+        self.versions = {0: (df, profile, None)} # position -> (df, profile, fingerprint)
+
+    def current(self):
+        return self.versions[self.position][0]
+
+    def can_undo(self) -> bool:
+        return self.position > 0
+
+    def can_redo(self) -> bool:
+        return self.position < len(self.ops)
+
+    def _leave(self):
+        # keep the current data's fingerprint, so coming back to it doesn't hash it again
+        df, profile, _ = self.versions[self.position]
+        cached = st.session_state.get("df_fingerprint")
+        fingerprint = cached[1] if cached and cached[0] == st.session_state.get("data_version", 0) else None
+        self.versions[self.position] = (df, profile, fingerprint)
+
+    def _keep(self, position, version):
+        self.versions.pop(position, None)
+        self.versions[position] = version # most recently visited last
+        while len(self.versions) > KEPT_VERSIONS + 1:
+            oldest = next(p for p in self.versions if p != 0)
+            del self.versions[oldest]
+
+    def apply(self, op):
+        """
+        Applies op to the current data and records it, dropping the edits that were undone.
+        """
+        self._leave()
+        df = apply_op(self.current(), op)
+        update_dataframe(df, **op_effect(op))
+        del self.ops[self.position:]
+        del self.dataset_ids[self.position + 1:]
+        for position in [p for p in self.versions if p > self.position]:
+            del self.versions[position]
+        self.ops.append(op)
+        record_op(op)
+        self.dataset_ids.append(st.session_state.dataset_id)
+        self.position += 1
+        self._keep(self.position, (df, st.session_state.profile, None))
+
+    def _move_to(self, position):
+        self._leave()
+        if position in self.versions:
+            df, profile, fingerprint = self.versions[position]
+            restore_dataframe(df, profile)
+        else:
+            start = max(p for p in self.versions if p < position)
+            df, profile, _ = self.versions[start]
+            restore_dataframe(df, profile)
+            for op in self.ops[start:position]:
+                update_dataframe(apply_op(st.session_state.df, op), **op_effect(op))
+            df, profile, fingerprint = st.session_state.df, st.session_state.profile, None
+        if fingerprint is not None:
+            st.session_state.df_fingerprint = (st.session_state.data_version, fingerprint)
+        self.position = position
+        self._keep(position, (df, profile, fingerprint))
+        st.session_state.dataset_id = self.dataset_ids[position]
+        if st.session_state.dataset_id is not None:
+            st.query_params["dataset"] = st.session_state.dataset_id
+
+    def undo(self):
+        self._move_to(self.position - 1)
+
+    def redo(self):
+        self._move_to(self.position + 1)
+
+def get_edit_log() -> EditLog:
+    """
+    The edit log of st.session_state.df, started afresh whenever the data was loaded
+    (or changed) some other way.
+    """
+    log = st.session_state.get("edit_log")
+    if log is None or log.current() is not st.session_state.df:
+        log = EditLog(st.session_state.df, st.session_state.profile, st.session_state.get("dataset_id"))
+        st.session_state.edit_log = log
+    return log
+
+def edit_dataframe(op):
+    """
+    Applies an edit (one of the dataset_store *_op dicts) to st.session_state.df, so it can be undone.
+    """
+    get_edit_log().apply(op)
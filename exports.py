@@ -0,0 +1,52 @@
+import io
+import streamlit as st
+import pandas as pd
+
+# Download files are only generated when a download button is clicked (Streamlit runs
+# the button's data callable then, on its own thread), and kept for the session until
+# the plot or data they were made from changes.
+PLOT_FORMATS = {
+    "PNG": ("png", "image/png"),
+    "SVG": ("svg", "image/svg+xml"),
+    "PDF": ("pdf", "application/pdf"),
+}
+PNG_DPI_OPTIONS = [100, 200, 300, 600]
+DATA_FORMATS = {
+    "CSV (gzip)": ("csv.gz", "application/gzip"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+def export_files(name, version) -> dict:
+    """
+    The session's generated files for one kind of download, emptied when version (the
+    render or data version they were made from) changes.
+    """
+    store = st.session_state.get(name)
+    if store is None or store["version"] != version:
+        store = {"version": version, "files": {}}
+        st.session_state[name] = store
+    return store["files"]
+
+def deferred(files: dict, key, make):
+    """
+    A download button data callable: builds the file with make() the first time it is
+    downloaded and keeps it in files under key.
+    """
+    def build():
+        if key not in files:
+            files[key] = make()
+        return files[key]
+    return build
+
+def save_figure(fig, fmt, dpi=None) -> bytes:
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt, dpi=dpi if fmt == "png" else None, bbox_inches="tight")
+    return buf.getvalue()
+
+def data_bytes(df: pd.DataFrame, ext) -> bytes:
+    buf = io.BytesIO()
+    if ext == "parquet":
+        df.to_parquet(buf)
+    else:
+        df.to_csv(buf, compression={"method": "gzip"})
+    return buf.getvalue()
@@ -0,0 +1,106 @@
+import os
+import time
+import weakref
+import threading
+
+# Figures never live in the web server process: workers draw them, close them and send
+# back bytes (see render_service). What a session does keep is those bytes - the PNG on
+# screen, the pickled figure used for restyles and exports, and the download files made
+# from it - and a big plot's pickle or PDF runs to tens of MB. The figure budget bounds
+# them per session and across the server, dropping what can be made again first.
+SESSION_FIGURE_BUDGET = int(os.environ.get("HAMMOCK_SESSION_FIGURE_MB", 64)) * 1024 * 1024
+TOTAL_FIGURE_BUDGET = int(os.environ.get("HAMMOCK_TOTAL_FIGURE_MB", 1024)) * 1024 * 1024
+
+class SessionFigures:
+    """
+    The plot a session shows: its PNG, its pickled figure (None if there is none or it
+    was evicted; restyles and exports then draw it again from the data) and the files
+    downloaded from it, by (format, dpi).
+    """
+    def __init__(self, png: bytes, fig_bytes=None):
+        self.png = png
+        self.fig_bytes = fig_bytes
+        self.exports = {}
+        self.last_used = time.monotonic()
+
+    def usage(self) -> dict:
+        return {"png": len(self.png or b""), "figure": len(self.fig_bytes or b""),
+                "exports": sum(len(data) for data in list(self.exports.values()))}
+
+    def nbytes(self) -> int:
+        return sum(self.usage().values())
+
+class FigureBudget:
+    """
+    Tracks the SessionFigures of every session, one per session: keeping a session's
+    new plot releases its last one. Past session_budget for one session or total_budget
+    across sessions, download files and then pickled figures are dropped, least recently
+    used sessions first. PNGs on screen are never dropped. Sessions that end are
+    forgotten with their session state.
+    """
+    def __init__(self, session_budget=SESSION_FIGURE_BUDGET, total_budget=TOTAL_FIGURE_BUDGET):
+        self.session_budget = session_budget
+        self.total_budget = total_budget
+        self.evicted_bytes = 0
+        self._figures = weakref.WeakValueDictionary() # session id -> SessionFigures
+        self._lock = threading.RLock()
+
+    def keep(self, session_id, figures: SessionFigures) -> SessionFigures:
+        with self._lock:
+            last = self._figures.get(session_id)
+            if last is not None and last is not figures:
+                self._release(last)
+            self._figures[session_id] = figures
+        self.enforce(figures)
+        return figures
+
+    def forget(self, session_id):
+        with self._lock:
+            figures = self._figures.pop(session_id, None)
+            if figures is not None:
+                self._release(figures)
+
+    def touch(self, figures: SessionFigures):
+        figures.last_used = time.monotonic()
+
+    def enforce(self, figures=None):
+        """
+        Evicts until figures (just changed) fits the session budget and every session
+        together fits the total budget.
+        """
+        with self._lock:
+            if figures is not None:
+                self.touch(figures)
+                self._shrink(figures, self.session_budget)
+            sessions = sorted(self._figures.values(), key=lambda f: f.last_used)
+            total = sum(f.nbytes() for f in sessions)
+            for f in sessions:
+                if total <= self.total_budget:
+                    break
+                total -= self._shrink(f, 0)
+
+    def _shrink(self, figures, target) -> int:
+        # download files are saved again on the next click; a dropped pickle costs a full render
+        freed = 0
+        if figures.exports and figures.nbytes() > target:
+            freed += figures.usage()["exports"]
+            figures.exports.clear()
+        if figures.fig_bytes is not None and figures.nbytes() > target:
+            freed += len(figures.fig_bytes)
+            figures.fig_bytes = None
+        self.evicted_bytes += freed
+        return freed
+
+    def _release(self, figures):
+        figures.png = figures.fig_bytes = None
+        figures.exports.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            usages = [f.usage() for f in self._figures.values()]
+        stats = {kind: sum(usage[kind] for usage in usages) for kind in ["png", "figure", "exports"]}
+        stats.update(sessions=len(usages), bytes=sum(stats.values()), evicted_bytes=self.evicted_bytes,
+                     session_budget=self.session_budget, total_budget=self.total_budget)
+        return stats
+
+figure_budget = FigureBudget()
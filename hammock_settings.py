@@ -6,12 +6,36 @@ import pandas as pd
 from utils import (
     Defaults,
     plot,
+    collect_render,
+    cancel_render,
+    clear_plot,
+    render_position,
+    plot_export,
+    DRAFT_ROWS,
     validate_expression,
     get_uni_type,
     set_snapshot_settings,
     set_default_settings,
     get_formatted_values,
+    paged_multiselect,
+    render_cache,
+    MAX_CATEGORICAL_LEVELS,
+    DEFAULT_BINS,
+    DEFAULT_TOP_N,
+    OTHER_LABEL,
+    BIN_METHODS,
+    LARGE_N_ROWS,
+    LARGE_N_LEVELS,
+    MAX_FACETS,
+    DEFAULT_FACET_COLUMNS,
 )
+from column_profile import get_profile, unique_values, weight_candidates
+from exports import PLOT_FORMATS, PNG_DPI_OPTIONS
+from sampling import SAMPLE_ROWS
+from data_preview import data_preview
+from perf import performance_panel
+from figure_store import figure_budget
+from batch_render import plot_spec, spec_json
 import ast
 
 if "reset_counter" not in st.session_state:
@@ -39,7 +63,34 @@ def run_plot_on_refresh():
     if not st.session_state.run_plot_soon:
         st.session_state.run_plot_soon = True
 
+def replot():
+    """
+    Re-renders the plot after a setting in a panel that refreshes it without Apply. The
+    panel reran on its own, so the whole page has to run for the plot to pick it up.
+    """
+    run_plot_on_refresh()
+    st.rerun()
+
+def default_unibar_settings(uni):
+    """
+    Resets uni's entries in the per-unibar settings to their defaults.
+    """
+    for settings in [st.session_state.numerical_var_levels, st.session_state.display_type,
+                     st.session_state.label_options, st.session_state.value_order, st.session_state.binning]:
+        settings.pop(uni, None)
+    type = get_uni_type(uni)
+    values = get_profile(uni).unique_values
+    if type == "numeric" and values is not None and (np.array_equal(values, [0, 1]) or np.array_equal(values, [1, 0])):
+        st.session_state.value_order[uni] = ["0", "1"]
+    if type == "numeric":
+        st.session_state.display_type[uni] = "box"
+
+# Each settings panel is a fragment: changing one of its widgets reruns just that panel,
+# which saves its values to st.session_state.plot_settings (or the per-unibar dicts).
+# The plot is drawn from there, with the panels' other inputs passed in as arguments.
+@st.fragment
 def display_unibar_specific_settings(uni):
+    default_unibar_settings(uni) # this panel sets them again below
     st.markdown(
         f"""
         <h3 style="
@@ -53,10 +104,11 @@ def display_unibar_specific_settings(uni):
         unsafe_allow_html=True
     )
     type = get_uni_type(uni)
+    profile = get_profile(uni)
 
     st.badge(type)
-    key_name = f"col_{uni}_uniquevals"
-    values = st.session_state[key_name]
+    st.caption(profile.describe_uniques())
+    values = profile.unique_values # None for high-cardinality columns
     
     # treat values that are just 0 and 1 as categorical by default
     default_value_order = False
@@ -67,12 +119,28 @@ def display_unibar_specific_settings(uni):
 
     if type == "numeric":
         force_categorical = False
-        if (np.array_equal(values, [0, 1]) or np.array_equal(values, [1, 0])):
+        if values is not None and (np.array_equal(values, [0, 1]) or np.array_equal(values, [1, 0])):
             force_categorical = True
         force_categorical = st.checkbox(label="Categorical", value=force_categorical, key=f"force_categorical_{uni}")
         if force_categorical:
-            desired_value_order = get_formatted_values(values)
-            st.session_state.value_order[uni] = desired_value_order
+            use_bins = st.checkbox(label="Bin values?", value=profile.n_unique > MAX_CATEGORICAL_LEVELS, key=f"bin_{uni}",
+                                   help="Group the values into ranges, so a column with many distinct values plots as a few bars")
+            if use_bins:
+                method = st.selectbox(label="Bins", options=BIN_METHODS, key=f"bin_method_{uni}")
+                spec = {"method": method}
+                if method == "custom breaks":
+                    breaks = st.text_input(label="Breaks", key=f"bin_breaks_{uni}", help="Comma separated, e.g. 0, 10, 100")
+                    try:
+                        spec["breaks"] = sorted(float(b) for b in breaks.split(",") if b.strip())
+                    except ValueError:
+                        st.error("Breaks must be numbers separated by commas")
+                        spec["breaks"] = []
+                else:
+                    spec["bins"] = st.number_input(label="Number of bins", min_value=1, value=DEFAULT_BINS, step=1, key=f"bin_count_{uni}")
+                st.session_state.binning[uni] = spec
+            else:
+                desired_value_order = get_formatted_values(unique_values(uni))
+                st.session_state.value_order[uni] = desired_value_order
             type = "categorical"
 
     
@@ -85,9 +153,11 @@ def display_unibar_specific_settings(uni):
             
 
     if type != "numeric":
-        custom_value_order = st.checkbox("Custom label order?", key=f"value_order_{uni}")
+        binned = uni in st.session_state.binning # ordered by bin
+        custom_value_order = st.checkbox("Custom label order?", key=f"value_order_{uni}", disabled=values is None or binned,
+                                         help="Not available for columns with this many distinct values" if values is None else None)
     
-        if custom_value_order:
+        if custom_value_order and values is not None and not binned:
             options = get_formatted_values(values)
             value_order = st.multiselect(label="Custom label order", options=options, help="Order of the values in the unibar, from bottom to top.")
 
@@ -97,6 +167,13 @@ def display_unibar_specific_settings(uni):
             st.session_state.value_order[uni] = value_order
             type = "categorical"
         
+        if get_uni_type(uni) != "numeric" and profile.n_unique > MAX_CATEGORICAL_LEVELS:
+            cap = st.checkbox(label="Group rare labels?", value=True, key=f"cap_{uni}",
+                              help=f"Plot only the most frequent labels and group the rest as \"{OTHER_LABEL}\"")
+            if cap:
+                top_n = st.number_input(label="Labels kept", min_value=1, value=DEFAULT_TOP_N, step=1, key=f"top_n_{uni}")
+                st.session_state.binning[uni] = {"method": "top", "n": top_n}
+
         uni_display_type = st.selectbox(label="display type", options=["stacked bar", "bar chart"], index=Defaults.DISPLAY_TYPE_INDEX, key=f"display_type_{uni}")       
     
     st.session_state.display_type[uni] = uni_display_type
@@ -126,7 +203,8 @@ else:
     st.write("View the Hammock plot documentation [here](%s)" % "https://github.com/TianchengY/hammock_plot/blob/main/README.md")
 
     st.sidebar.subheader("Your data")
-    st.sidebar.dataframe(st.session_state.df, hide_index=True) # put the dataframe in the sidebar
+    with st.sidebar: # put the dataframe in the sidebar
+        data_preview("sidebar_preview", hide_index=True)
 
     unibars = st.multiselect(label = "Which variables do you want to plot?", options=list(st.session_state.df))
     
@@ -139,9 +217,126 @@ else:
     if not unibars or len(unibars) == 0:
         st.markdown(":gray[Select variables to proceed]")
     else:
+        # manage session_state variables
+        st.session_state.plot_settings = {}
+        st.session_state.numerical_var_levels = {}
+        st.session_state.display_type = {}
+        st.session_state.label_options = {}
+        st.session_state.value_order = {}
+        st.session_state.binning = {}
+
+        # initialize numerical display type defaults
+        for uni in unibars:
+            default_unibar_settings(uni)
+
+    @st.fragment
+    def weight_panel(unibars):
+        use_weights = st.checkbox(label="Use weights?")
+        weights = None
+        
+        if use_weights:
+            valid_columns = [var for var in weight_candidates() if var not in unibars]
+
+            if len(valid_columns) == 0:
+                st.warning("The weight variable is not valid. It must be numeric without missing values.")
+            else:
+                weights = st.selectbox(
+                    label="Select weight variable",
+                    options=valid_columns,
+                    help="A variable that acts like a weight for a data entry. Cannot have negative or missing values."
+                )
+        st.session_state.plot_settings["weights"] = weights if use_weights else None
+
+        if st.session_state.weights != weights or st.session_state.use_weights != use_weights:
+            st.session_state.weights = weights
+            st.session_state.use_weights = use_weights
+            replot()
+
+    @st.fragment
+    def sampling_panel():
+        st.header("Sampling")
+        use_sample = st.checkbox(label="Explore on a sample?", key="use_sample",
+                                 help="Plot a weighted sample of the data that keeps every category of the unibars with few values and every highlighted group. Much faster for very large data.")
+        sample_rows = None
+        if use_sample:
+            sample_size = st.number_input(label="Sample size (rows)", min_value=1000, value=SAMPLE_ROWS, step=10000, key="sample_size")
+            exact = st.toggle(label="Exact", key="sample_exact", help="Plot the full data, e.g. for the final plot you download")
+            sample_rows = None if exact else int(sample_size)
+        st.session_state.plot_settings["sample_rows"] = sample_rows
+        if st.session_state.get("sample_rows") != sample_rows:
+            st.session_state.sample_rows = sample_rows
+            replot()
+
+    @st.fragment
+    def facet_panel(unibars):
+        st.header("Facets")
+        use_facets = st.checkbox(label="Split into panels?", key="use_facets",
+                                 help="Draw the plot once per value of a column, with the same label order and bins in every panel. The panels render in parallel.")
+        facet = None
+        if use_facets:
+            valid_columns = [col for col in st.session_state.df.columns if col not in unibars
+                             and get_profile(col).n_unique_exact and 2 <= get_profile(col).n_unique <= MAX_FACETS]
+            if len(valid_columns) == 0:
+                st.warning(f"No column to facet on. It must not be a unibar and have 2 to {MAX_FACETS} values.")
+            else:
+                column = st.selectbox(label="Panel for each value of", options=valid_columns, key="facet_column")
+                ncols = st.number_input(label="Panels per row", min_value=1, max_value=MAX_FACETS,
+                                        value=DEFAULT_FACET_COLUMNS, step=1, key="facet_ncols")
+                st.caption(f"{get_profile(column).describe_uniques()}; rows without a value are left out.")
+                facet = {"column": column, "ncols": int(ncols)}
+        st.session_state.plot_settings["facet"] = facet
+        if st.session_state.get("facet") != facet:
+            st.session_state.facet = facet
+            replot()
+
+    @st.fragment
+    def highlight_panel(missing):
+        st.header("Highlighting")
+        highlight = st.checkbox("Enable highlighting?", value=False, key=f"highlight_{st.session_state.reset_counter}")
+        hi_var, hi_value, hi_box, hi_missing, hi_colors = None, None, None, False, []
+        if highlight:
+            hi_var = st.selectbox(label="Select the variable to highlight", options=list(st.session_state.df))
+            subcols = st.columns(2)
+            hi_options = ["specific labels", "expression"]
+            hi_type = subcols[0].radio("Highlight type", options=hi_options)
+            hi_box = subcols[1].radio("Highlight box", options=["side-by-side", "stacked"])
+
+            if hi_type == hi_options[0]: # highlighting specific labels
+                hi_value = paged_multiselect(label="Select labels to highlight", col=hi_var, key=f"hi_value_{hi_var}")
+            else:
+                hi_value = st.text_input(label="Expression (regex/range) to highlight", help="e.g. x>1 and (x>5 or x<4)")
+                if hi_value != "" and not validate_expression(hi_value):
+                    st.error("Must provide a valid expression (regex/range)")
+            if missing:
+                hi_missing = st.checkbox("Highlight missing values?")
+            else:
+                hi_missing = False
+            num_highlight = len(hi_value) if hi_type == hi_options[0] else 1
+            num_highlight += 1 if hi_missing else 0
+            cols = st.columns(4)  # create 3 columns
+
+            for i in range(num_highlight):
+                col = cols[i % 4]  # rotate through the 3 columns
+                with col:
+                    hi_colors.append(
+                        st.color_picker(
+                            label=f"Colour #{i+1}",
+                            value=Defaults.HI_COLORS[i] if i < len(Defaults.HI_COLORS) else "#00ff00",
+                            key = f"hi_colors_{i}_{st.session_state.reset_counter}",
+                        )
+                    )
+            
+            # the picker's own state: general_panel, which draws it, runs after this panel and reruns on its own
+            default_color = st.session_state.get(f"default_color_{st.session_state.reset_counter}", Defaults.DEFAULT_COLOR)
+            if default_color in hi_colors:
+                st.error("Warning! Default colour is same as a highlight colour")
+        st.session_state.plot_settings.update(hi_var=hi_var, hi_value=hi_value, hi_box=hi_box,
+                                              hi_missing=hi_missing, colors=hi_colors)
+
+    @st.fragment
+    def general_panel(missing, fig_width):
         # load default settings
         fig_height = Defaults.HEIGHT
-        fig_width = max(Defaults.WIDTH, len(unibars) * 4/3)
         default_color = Defaults.DEFAULT_COLOR
         alpha = Defaults.ALPHA
         label = True
@@ -153,31 +348,90 @@ else:
         connector_fraction = Defaults.CONNECTOR_FRACTION
         shape = "rectangle"
         connector_color = None
-        same_scale = []
-        violin_bw_method = "scott"
 
-        # manage session_state variables
-        st.session_state.numerical_var_levels = {}
-        st.session_state.display_type = {}
-        st.session_state.label_options = {}
-        st.session_state.value_order = {}
-
-        # initialize numerical display type defaults
-        for uni in unibars:
-            type = get_uni_type(uni)
-            key_name = f"col_{uni}_uniquevals"
-            values = st.session_state[key_name]
-            if type == "numeric" and (np.array_equal(values, [0, 1]) or np.array_equal(values, [1, 0])):
-                st.session_state.value_order[uni] = ["0", "1"]
-            if type == "numeric":
-                st.session_state.display_type[uni] = "box"
+        st.subheader("General")
+        subcol1, subcol2 = st.columns([1, 1])
+        fig_height = subcol1.number_input(label="Height", value=fig_height, step=0.5, key=f"height_{st.session_state.reset_counter}",
+                                    help="Height of the plot")
+        fig_width = subcol2.number_input(label="Width", value=fig_width, step=0.5, key=f"width_{st.session_state.reset_counter}",
+                                    help="Width of the plot")
+        
+        min_bar_height = st.number_input(label="Minimum bar height",
+                                            value=min_bar_height,
+                                            key=f"min_bar_height_{st.session_state.reset_counter}",
+                                            help="Bars representing only a tiny fraction of the data may be so narrow that they are invisible in a plot. This parameter ensures that no bars can be thinner than the minimum.")
+
+        subcol1, subcol2 = st.columns([1, 1])
+        default_color = subcol1.color_picker(label="Default colour", value=default_color, key=f"default_color_{st.session_state.reset_counter}",
+                                            help="The default, unhighlighted colour of the plot")
+        # highlight colours as the highlight panel last saved them; that panel warns as they change
+        if default_color in st.session_state.plot_settings.get("colors", []):
+            st.error("Warning! Default colour is same as a highlight colour")
+        alpha = subcol1.slider(label="Opacity", value=alpha, min_value=0, max_value=100, format="%d%%")
+
+        label = subcol2.checkbox(label="Display labels?", value=label, help="Whether or not to display the text labels")
+        unibar = subcol2.checkbox(label="Display unibars?", value=unibar, help="Whether or not to display unibars")
+
+        if not label and not unibar:
+            uni_hfill = 0
+        
+        if missing:
+            missing_placeholder = subcol1.text_input(label="Missing value label", value=missing_placeholder,
+                                                    help="The label for missing values")
+            
+        subcol1, subcol2 = st.columns([1, 1])
+        uni_vfill = subcol1.slider(label="Unibar Vertical Fill",
+                                key=f"uni_vfill_{st.session_state.reset_counter}",
+                                min_value=0, max_value=100,
+                                value=uni_vfill, format="%d%%",
+                                help="Fraction of vertical space that should be populated by data. Adjusts the height of the data points.")
+        uni_hfill = subcol2.slider(label="Unibar Horizontal Fill",
+                                key=f"uni_hfill_{st.session_state.reset_counter}",
+                                min_value=0, max_value=100, 
+                                value=uni_hfill, format="%d%%",
+                                help="Fraction of horizontal space allocated to labels/univ. bars rather than to connecting boxes.",
+                                disabled=not(label or unibar))
+        if st.session_state["mode"] != "snapshot":
+            connector_fraction = subcol1.slider(label="Connector Fraction",
+                                                key=f"connect_frac_{st.session_state.reset_counter}",
+                                                value=connector_fraction,
+                                                min_value=0, max_value=100,format="%d%%",
+                                                help="Fraction of the uni_vfill height used for drawing connectors between unibars. Controls how tall the connectors are relative to the bar height.")
+            custom_connector_color = subcol1.checkbox(label="Separate Connector Color?", key=f"custom_connect_color_{st.session_state.reset_counter}", value=False)
+            shape = subcol2.selectbox(label="Connector Shape",
+                                    key=f"shape_{st.session_state.reset_counter}",
+                                    options=["rectangle", "parallelogram"],
+                                    help="Shape of the connectors.")
+            connector_color = None if not custom_connector_color else subcol2.color_picker(label="Connector color", value=default_color, key=f"connect_color_{st.session_state.reset_counter}")
+
+        st.session_state.plot_settings.update(
+            height=fig_height, width=fig_width, min_bar_height=min_bar_height,
+            default_color=default_color, alpha=alpha / 100, label=label, unibar=unibar,
+            missing_placeholder=missing_placeholder if missing else None,
+            uni_vfill=uni_vfill / 100, uni_hfill=uni_hfill / 100, connector_fraction=connector_fraction / 100,
+            shape=shape, connector_color=connector_color,
+        )
+
+    @st.fragment
+    def unibar_common_panel(unibars):
+        same_scale = st.multiselect(label="Variables to use same scale", options=unibars)
+        same_scale_type = get_uni_type(same_scale[0]) if same_scale else None
+        for uni in same_scale:
+            if same_scale_type != get_uni_type(uni):
+                st.error("Variables in same_scale must either all be numerical or all be categorical")
+        violin_bw_method = st.selectbox(label="violin plot bw method [(see matplotlib documentation)](https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.violinplot.html)", options=["scott", "silverman", "custom float"])
+        if violin_bw_method == "custom float":
+            violin_bw_method = st.number_input("custom float", min_value=0.0, value=0.5, step=0.1)
+        large_n = st.checkbox(label="Fast rugplots and violins for large data", value=True,
+                              help=f"With more than {LARGE_N_ROWS:,} rows, draw rugplots and violins from values binned to {LARGE_N_LEVELS:,} positions, which looks the same. Uncheck to draw every value exactly.")
+        st.session_state.plot_settings.update(same_scale=same_scale, violin_bw_method=violin_bw_method, large_n=large_n)
 
     if unibars:
         container = st.container(border=True)
         with container:
             plotcol, customcol = adjustable_columns([2, 1], labels=["Graph", "Settings"])
             with customcol:
-                presets, highlight_settings, uni_spec, general, weight_settings = st.tabs(["Preset Settings", "Highlighting", "Unibar-Specific", "Advanced", "Weights"])
+                presets, highlight_settings, uni_spec, general, weight_settings, sampling_settings, facet_settings = st.tabs(["Preset Settings", "Highlighting", "Unibar-Specific", "Advanced", "Weights", "Sampling", "Facets"])
                 with presets:
                     st.header("Preset Setting Options")
                     st.text("Sets all settings to preset options. Refreshes the plot.")
@@ -200,201 +454,145 @@ else:
                         # st.rerun()
                 # ------ WEIGHT SETTINGS --------
                 with weight_settings:
-                    use_weights = st.checkbox(label="Use weights?")
-                    weights = None
-                    
-                    if use_weights:
-                        df = st.session_state.df
-                        valid_columns = [var for var in st.session_state.possible_weightvars if var not in unibars]
-
-                        if len(valid_columns) == 0:
-                            st.warning("The weight variable is not valid. It must be numeric without missing values.")
-                        else:
-                            weights = st.selectbox(
-                                label="Select weight variable",
-                                options=valid_columns,
-                                help="A variable that acts like a weight for a data entry. Cannot have negative or missing values."
-                            )
-                            if st.session_state.weights != weights:
-                                st.session_state.weights = weights
-                                run_plot_on_refresh()
-
-                    if st.session_state.use_weights != use_weights:
-                        st.session_state.use_weights = use_weights
-                        run_plot_on_refresh()
+                    weight_panel(unibars)
+                # ------ SAMPLING SETTINGS --------
+                with sampling_settings:
+                    sampling_panel()
+                # ------ FACET SETTINGS --------
+                with facet_settings:
+                    facet_panel(unibars)
                 # ------ HIGHLIGHT SETTINGS ---------
                 with highlight_settings:
-                    st.header("Highlighting")
-                    highlight = st.checkbox("Enable highlighting?", value=False, key=f"highlight_{st.session_state.reset_counter}")
-                    if highlight:
-                        hi_var = st.selectbox(label="Select the variable to highlight", options=list(st.session_state.df))
-                        subcols = st.columns(2)
-                        hi_options = ["specific labels", "expression"]
-                        hi_type = subcols[0].radio("Highlight type", options=hi_options)
-                        hi_box = subcols[1].radio("Highlight box", options=["side-by-side", "stacked"])
-
-                        key_name = f"col_{hi_var}_uniquevals"
-                        hi_values = st.session_state[key_name]
-                        hi_label_options = get_formatted_values(hi_values)
-                        if hi_type == hi_options[0]: # highlighting specific labels
-                            hi_value = st.multiselect(label="Select labels to highlight", options=hi_label_options)
-                        else:
-                            hi_value = st.text_input(label="Expression (regex/range) to highlight", help="e.g. x>1 and (x>5 or x<4)")
-                            if hi_value != "" and not validate_expression(hi_value):
-                                st.error("Must provide a valid expression (regex/range)")
-                        if missing:
-                            hi_missing = st.checkbox("Highlight missing values?")
-                        else:
-                            hi_missing = False
-                        num_highlight = len(hi_value) if hi_type == hi_options[0] else 1
-                        num_highlight += 1 if hi_missing else 0
-                        hi_colors = []
-                        cols = st.columns(4)  # create 3 columns
-
-                        for i in range(num_highlight):
-                            col = cols[i % 4]  # rotate through the 3 columns
-                            with col:
-                                hi_colors.append(
-                                    st.color_picker(
-                                        label=f"Colour #{i+1}",
-                                        value=Defaults.HI_COLORS[i] if i < len(Defaults.HI_COLORS) else "#00ff00",
-                                        key = f"hi_colors_{i}_{st.session_state.reset_counter}",
-                                    )
-                                )
-                        
-                        for color in hi_colors:
-                            if color == default_color:
-                                st.error("Warning! Default colour is same as a highlight colour")
+                    highlight_panel(missing)
                 with general:
                     # ------------ GENERAL SETTINGS ----------------------
-                    st.subheader("General")
-                    subcol1, subcol2 = st.columns([1, 1])
-                    fig_height = subcol1.number_input(label="Height", value=fig_height, step=0.5, key=f"height_{st.session_state.reset_counter}",
-                                                help="Height of the plot")
-                    fig_width = subcol2.number_input(label="Width", value=fig_width, step=0.5, key=f"width_{st.session_state.reset_counter}",
-                                                help="Width of the plot")
-                    
-                    min_bar_height = st.number_input(label="Minimum bar height",
-                                                        value=min_bar_height,
-                                                        key=f"min_bar_height_{st.session_state.reset_counter}",
-                                                        help="Bars representing only a tiny fraction of the data may be so narrow that they are invisible in a plot. This parameter ensures that no bars can be thinner than the minimum.")
-
-                    subcol1, subcol2 = st.columns([1, 1])
-                    default_color = subcol1.color_picker(label="Default colour", value=default_color, key=f"default_color_{st.session_state.reset_counter}",
-                                                        help="The default, unhighlighted colour of the plot")
-                    alpha = subcol1.slider(label="Opacity", value=alpha, min_value=0, max_value=100, format="%d%%")
-
-                    label = subcol2.checkbox(label="Display labels?", value=label, help="Whether or not to display the text labels")
-                    unibar = subcol2.checkbox(label="Display unibars?", value=unibar, help="Whether or not to display unibars")
-
-                    if not label and not unibar:
-                        uni_hfill = 0
-                    
-                    if missing:
-                        missing_placeholder = subcol1.text_input(label="Missing value label", value=missing_placeholder,
-                                                                help="The label for missing values")
-                        
-                    subcol1, subcol2 = st.columns([1, 1])
-                    uni_vfill = subcol1.slider(label="Unibar Vertical Fill",
-                                            key=f"uni_vfill_{st.session_state.reset_counter}",
-                                            min_value=0, max_value=100,
-                                            value=uni_vfill, format="%d%%",
-                                            help="Fraction of vertical space that should be populated by data. Adjusts the height of the data points.")
-                    uni_hfill = subcol2.slider(label="Unibar Horizontal Fill",
-                                            key=f"uni_hfill_{st.session_state.reset_counter}",
-                                            min_value=0, max_value=100, 
-                                            value=uni_hfill, format="%d%%",
-                                            help="Fraction of horizontal space allocated to labels/univ. bars rather than to connecting boxes.",
-                                            disabled=not(label or unibar))
-                    if st.session_state["mode"] != "snapshot":
-                        connector_fraction = subcol1.slider(label="Connector Fraction",
-                                                            key=f"connect_frac_{st.session_state.reset_counter}",
-                                                            value=connector_fraction,
-                                                            min_value=0, max_value=100,format="%d%%",
-                                                            help="Fraction of the uni_vfill height used for drawing connectors between unibars. Controls how tall the connectors are relative to the bar height.")
-                        custom_connector_color = subcol1.checkbox(label="Separate Connector Color?", key=f"custom_connect_color_{st.session_state.reset_counter}", value=False)
-                        shape = subcol2.selectbox(label="Connector Shape",
-                                                key=f"shape_{st.session_state.reset_counter}",
-                                                options=["rectangle", "parallelogram"],
-                                                help="Shape of the connectors.")
-                        connector_color = None if not custom_connector_color else subcol2.color_picker(label="Connector color", value=default_color, key=f"connect_color_{st.session_state.reset_counter}")
+                    general_panel(missing, max(Defaults.WIDTH, len(unibars) * 4/3))
                 
                 with uni_spec:
                     # ------ UNIBAR SPECIFIC SETTINGS ---------
                     st.subheader("Unibar-Specific")
-                    
-                    same_scale = st.multiselect(label="Variables to use same scale", options=unibars)
-                    same_scale_type = get_uni_type(same_scale[0]) if same_scale else None
-                    for uni in same_scale:
-                        if same_scale_type != get_uni_type(uni):
-                            st.error("Variables in same_scale must either all be numerical or all be categorical")
-                    violin_bw_method = st.selectbox(label="violin plot bw method [(see matplotlib documentation)](https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.violinplot.html)", options=["scott", "silverman", "custom float"])
-                    if violin_bw_method == "custom float":
-                        violin_bw_method = st.number_input("custom float", min_value=0.0, value=0.5, step=0.1)
+                    unibar_common_panel(unibars)
                     
                     for uni in unibars:
                         display_unibar_specific_settings(uni)
             
             def run_plot():
-                with st.spinner("Plotting hammock... this may take a while"):
-                    plot(
-                        var=unibars,
-                        weights=weights if use_weights else None,
-                        value_order=st.session_state.value_order,
-                        numerical_var_levels=st.session_state.numerical_var_levels,
-                        display_type=st.session_state.display_type,
-                        missing=missing,
-                        missing_placeholder=missing_placeholder if missing else None,
-                        label=label,
-                        unibar=unibar,
-
-                        hi_var=hi_var if highlight else None,
-                        hi_value=hi_value if highlight else None,
-                        hi_box=hi_box if highlight else None,
-                        hi_missing=hi_missing if highlight else False,
-                        colors=hi_colors if highlight else [],
-                        default_color=default_color,
-                        uni_vfill=uni_vfill / 100,
-                        connector_fraction=connector_fraction / 100,
-                        connector_color = connector_color,
-                        uni_hfill=uni_hfill / 100,
-                        label_options=st.session_state.label_options,
-                        height=fig_height,
-                        width=fig_width,
-                        min_bar_height=min_bar_height,
-                        alpha=alpha / 100,
-                        shape=shape,
-                        same_scale=same_scale,
-                        violin_bw_method=violin_bw_method,
-                    )
-            with plotcol:
-                # -------- PLOT GRAPH -----------
-                if st.session_state.run_plot_soon:
-                    st.session_state.run_plot_soon = False
-                    run_plot()
-                if "fig" in st.session_state:
+                settings = st.session_state.plot_settings
+                plot(
+                    var=unibars,
+                    weights=settings["weights"],
+                    value_order=st.session_state.value_order,
+                    numerical_var_levels=st.session_state.numerical_var_levels,
+                    display_type=st.session_state.display_type,
+                    missing=missing,
+                    missing_placeholder=settings["missing_placeholder"],
+                    label=settings["label"],
+                    unibar=settings["unibar"],
+
+                    hi_var=settings["hi_var"],
+                    hi_value=settings["hi_value"],
+                    hi_box=settings["hi_box"],
+                    hi_missing=settings["hi_missing"],
+                    colors=settings["colors"],
+                    default_color=settings["default_color"],
+                    uni_vfill=settings["uni_vfill"],
+                    connector_fraction=settings["connector_fraction"],
+                    connector_color = settings["connector_color"],
+                    uni_hfill=settings["uni_hfill"],
+                    label_options=st.session_state.label_options,
+                    height=settings["height"],
+                    width=settings["width"],
+                    min_bar_height=settings["min_bar_height"],
+                    alpha=settings["alpha"],
+                    shape=settings["shape"],
+                    same_scale=settings["same_scale"],
+                    violin_bw_method=settings["violin_bw_method"],
+                    binning=st.session_state.binning,
+                    large_n=settings["large_n"],
+                    facet=settings["facet"],
+                    sample_rows=settings["sample_rows"],
+                )
+            def show_plot():
+                status = collect_render()
+                if status == "done":
+                    st.rerun() # stop polling and show the new plot
+                if isinstance(status, Exception):
+                    st.error(str(status))
+                if status == "pending":
+                    subcol1, subcol2 = st.columns([3, 1])
+                    ahead = render_position()
+                    if ahead is not None:
+                        queue_note = f"{ahead} render{'s' if ahead > 1 else ''} ahead of you" if ahead else "you're next"
+                        subcol1.info(f"Waiting for a free render worker... {queue_note}", icon=":material/hourglass_top:")
+                    else:
+                        subcol1.info("Plotting hammock... this may take a while", icon=":material/hourglass_top:")
+                    if subcol2.button("Cancel", use_container_width=True):
+                        cancel_render()
+                        st.rerun()
+
+                draft = st.session_state.get("draft_buf") if status == "pending" else None
+                if draft is not None:
+                    st.image(draft, use_container_width=True,
+                             caption=f"DRAFT - a {DRAFT_ROWS:,} row sample at low resolution. The exact plot replaces it when it's ready.")
+
+                if "figures" in st.session_state:
                     if not unibars:
-                        del st.session_state["fig"]
-                        del st.session_state["buf"]
+                        clear_plot()
                         st.rerun()
-                    st.image(st.session_state.buf, use_container_width=True) # display fig in streamlit
+                    if draft is None:
+                        st.image(st.session_state.figures.png, use_container_width=True) # display fig in streamlit
+                        cache_stats = render_cache.stats()
+                        figure_stats = figure_budget.stats()
+                        st.caption(f"Render cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                                   f"{cache_stats['entries']} plots ({cache_stats['bytes'] / 1e6:.1f} MB). "
+                                   f"Plot memory: {st.session_state.figures.nbytes() / 2**20:.1f} MB this session, "
+                                   f"{figure_stats['bytes'] / 2**20:.1f} of {figure_stats['total_budget'] / 2**20:,.0f} MB "
+                                   f"across {figure_stats['sessions']} sessions")
+                        sample = st.session_state.fig_source["sample"]
+                        if sample is not None:
+                            st.caption(f"SAMPLE - {sample['rows']:,} of {sample['total']:,} rows in {sample['strata']:,} strata. "
+                                       f"Bars of unibars with few values are exact; other bars are within "
+                                       f"±{sample['max_error'] * 100:.2f} percentage points (95%). Turn on Exact in Sampling for the full data.")
                     
                     if st.button("**Apply Custom Settings**", type="primary", use_container_width=True, help="Refresh when you update settings"):
                         # run_plot()
                         st.session_state.run_plot_soon = True
                         st.rerun()
                     subcol1, subcol2 = st.columns(2)
-                    with subcol1:
+                    with subcol1.popover("Download", icon=":material/download:", use_container_width=True):
+                        # faceted plots are assembled as one image
+                        formats = ["PNG"] if "facet_plan" in st.session_state.fig_source else list(PLOT_FORMATS)
+                        export_format = st.selectbox("Format", formats, key="plot_export_format")
+                        ext, mime = PLOT_FORMATS[export_format]
+                        dpi = st.selectbox("DPI", PNG_DPI_OPTIONS, key="plot_export_dpi") if ext == "png" else None
                         st.download_button(
-                            label="Download as PNG",
-                            data=st.session_state.buf,
-                            file_name="my_plot.png",
-                            mime="image/png",
+                            label=f"Download as {export_format}",
+                            data=plot_export(ext, dpi), # only saved when clicked
+                            file_name=f"my_plot.{ext}",
+                            mime=mime,
                             icon=":material/download:",
                             use_container_width=True,
                         )
+                        st.download_button(
+                            label="Settings (JSON)",
+                            data=spec_json(plot_spec(st.session_state.fig_source["settings"], fmt=ext, dpi=dpi)),
+                            file_name="my_plot.json",
+                            mime="application/json",
+                            icon=":material/data_object:",
+                            use_container_width=True,
+                            help="The plot's settings, to draw it again from the command line with batch_render.py",
+                        )
                     with subcol2: 
                         if st.button("Clear plot", use_container_width=True):
-                            del st.session_state["fig"]
-                            del st.session_state["buf"]
-                            st.rerun()
\ No newline at end of file
+                            clear_plot()
+                            st.rerun()
+                performance_panel()
+
+            with plotcol:
+                # -------- PLOT GRAPH -----------
+                if st.session_state.run_plot_soon:
+                    st.session_state.run_plot_soon = False
+                    run_plot() # renders in the background
+                # poll for the result while a render is running; the rest of the page stays usable
+                rendering = st.session_state.get("render_job") is not None
+                st.fragment(show_plot, run_every=0.5 if rendering else None)()
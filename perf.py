@@ -0,0 +1,163 @@
+import io
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import pstats
+import contextlib
+from collections import deque
+import streamlit as st
+
+try:
+    import resource # not on Windows
+except ImportError:
+    resource = None
+
+# Each load and render records how long its stages took, with the row counts that
+# explain it, to the "Performance" panel and as one JSON log line. Set HAMMOCK_PROFILE=1
+# to also run renders under cProfile and show the top of the profile in the panel.
+PROFILE_RENDERS = os.environ.get("HAMMOCK_PROFILE", "") not in ("", "0")
+PROFILE_LINES = 40
+KEPT_RECORDS = 20 # records kept per session for the panel
+
+logger = logging.getLogger("hammock_webapp.perf")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get("HAMMOCK_LOG_LEVEL", "INFO"))
+
+def reset_peak_memory() -> bool:
+    """
+    Restarts this process's resident memory high-water mark, so peak_memory_mb() measures
+    from now on. Linux only; returns False where it can't be done.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_memory_mb(since_reset=True):
+    """
+    Peak resident memory of this process in MB: since the last reset_peak_memory() if
+    since_reset (and it can be read), else over the process's whole life. None where it
+    can't be read at all.
+    """
+    if since_reset:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+class StageTimer:
+    """
+    Times the stages of one job (a data load or a render) and collects counts about it,
+    and the job's peak memory. Works in render workers too: record() is a plain dict that
+    is sent back with the result.
+    The peak is the process's from the timer's creation to record(), which is the job's
+    own in a render worker (one job at a time). In the web server, jobs of other
+    sessions running at the same time are included. Where the peak can't be reset it
+    is the process's lifetime peak, and "peak_scope" says so.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.stages = {}
+        self.counts = {}
+        self.profile = None
+        self.peak_reset = reset_peak_memory()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name, seconds):
+        """
+        Adds seconds timed elsewhere (e.g. waiting on other processes) to a stage.
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    @contextlib.contextmanager
+    def profiled(self):
+        """
+        Runs the block under cProfile if HAMMOCK_PROFILE is set, keeping the top of the profile.
+        """
+        if not PROFILE_RENDERS:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            self.profile = out.getvalue()
+
+    def record(self) -> dict:
+        return {
+            "job": self.job,
+            "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            "total": round(sum(self.stages.values()), 4),
+            "counts": self.counts,
+            "peak_mb": peak_memory_mb(self.peak_reset),
+            "peak_scope": "job" if self.peak_reset else "process",
+            "pid": os.getpid(),
+            "profile": self.profile,
+        }
+
+def log_record(record, keep=True):
+    """
+    Logs a StageTimer record as one JSON line and, with keep, keeps it for the session's
+    Performance panel (only possible during a script run).
+    """
+    logger.info(json.dumps({key: value for key, value in record.items() if key != "profile"}, default=str))
+    if keep:
+        if "perf_records" not in st.session_state:
+            st.session_state.perf_records = deque(maxlen=KEPT_RECORDS)
+        st.session_state.perf_records.append(record)
+
+def performance_panel():
+    """
+    Collapsible panel with the latest record of each kind of job in the session.
+    """
+    records = st.session_state.get("perf_records")
+    with st.expander("Performance"):
+        if not records:
+            st.caption("Nothing timed yet")
+            return
+        latest = {}
+        for record in records:
+            latest[record["job"]] = record
+        for job, record in latest.items():
+            counts = ", ".join(f"{name}: {value:,}" if isinstance(value, int) and not isinstance(value, bool) else f"{name}: {value}"
+                               for name, value in record["counts"].items())
+            memory = ""
+            if record["peak_mb"] is not None:
+                lifetime = " (process lifetime)" if record["peak_scope"] == "process" else ""
+                memory = f", peak memory {record['peak_mb']:,} MB{lifetime}"
+            st.markdown(f"**{job}** · {record['total']:.2f}s{memory}")
+            if counts:
+                st.caption(counts)
+            st.dataframe({"stage": list(record["stages"]), "seconds": list(record["stages"].values())}, hide_index=True)
+            if record["profile"]:
+                st.code(record["profile"], language=None)
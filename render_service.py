@@ -0,0 +1,372 @@
+import os
+import pickle
+import functools
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import streamlit as st
+
+# Renders run in a pool of worker processes shared by every session on the server, so
+# they use all the cores and a huge plot's memory never lands in the web server process.
+RENDER_WORKERS = int(os.environ.get("HAMMOCK_RENDER_WORKERS", os.cpu_count() or 1))
+RENDER_QUEUE_SIZE = int(os.environ.get("HAMMOCK_RENDER_QUEUE", 32)) # renders waiting for a worker, across all sessions
+WORKER_MAX_RENDERS = 50 # a worker is replaced after this many renders, handing back memory kept from big plots
+
+class RenderQueueFull(Exception):
+    pass
+
+def _init_worker():
+    # pay for the heavy imports once per worker rather than once per render
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot
+    import hammock_plot
+    import utils
+
+def _noop():
+    pass
+
+@functools.lru_cache(maxsize=4)
+def _worker_dataset(dataset_id):
+    from dataset_store import open_dataset
+    df = open_dataset(dataset_id)
+    if df is None:
+        raise RuntimeError("The dataset is no longer in the store, please upload it again.")
+    return df
+
+def _closes_figures(task):
+    """
+    Closes every figure the task opened when it's done, including one left open by an
+    error part way through a render, so a worker's figure registry doesn't grow from
+    one render to the next.
+    """
+    @functools.wraps(task)
+    def run(*args):
+        import matplotlib.pyplot as plt
+        before = set(plt.get_fignums())
+        try:
+            return task(*args)
+        finally:
+            for num in set(plt.get_fignums()) - before:
+                plt.close(num)
+    return run
+
+def _pickle_figure(fig):
+    try:
+        return pickle.dumps(fig)
+    except Exception:
+        return None # the next change gets a full render instead of a restyle
+
+@_closes_figures
+def render_task(data, plot_args):
+    """
+    Runs in a worker. data is a dataset store id, or the dataframe itself if it couldn't
+    be stored. Returns (pickled figure or None, PNG, perf record); the figure is closed
+    in the worker.
+    """
+    import matplotlib.pyplot as plt
+    from utils import render_plot
+    from perf import StageTimer
+    timer = StageTimer("render")
+    with timer.profiled():
+        with timer.stage("load data"):
+            df = _worker_dataset(data) if isinstance(data, str) else data
+        fig, png = render_plot(df, plot_args, timer=timer)
+        with timer.stage("pickle figure"):
+            fig_bytes = _pickle_figure(fig)
+        plt.close(fig)
+    return fig_bytes, png, timer.record()
+
+@_closes_figures
+def draft_task(data, plot_args, rows, levels, dpi) -> bytes:
+    """
+    Runs in a worker. A quick preview: the plot of a random sample of rows, with numeric
+    unibars coarsened to a few levels, at low dpi.
+    """
+    import matplotlib.pyplot as plt
+    from utils import render_plot
+    df = _worker_dataset(data) if isinstance(data, str) else data
+    if len(df) > rows:
+        df = df.sample(n=rows, random_state=0)
+    fig, png = render_plot(df, plot_args, dpi, draft_levels=levels)
+    plt.close(fig)
+    return png
+
+@_closes_figures
+def restyle_task(fig_bytes, old_args, data, plot_args):
+    """
+    Runs in a worker. Restyles a pickled figure drawn with old_args to plot_args and
+    exports it again, falling back to a full render if it can't be restyled.
+    """
+    import matplotlib.pyplot as plt
+    from utils import figure_to_png
+    from restyle import restyle_figure
+    from perf import StageTimer
+    timer = StageTimer("restyle")
+    with timer.profiled():
+        with timer.stage("restyle"):
+            fig = pickle.loads(fig_bytes)
+            restyled = restyle_figure(fig, old_args, plot_args)
+        try:
+            if not restyled:
+                return render_task(data, plot_args)
+            with timer.stage("savefig"):
+                png = figure_to_png(fig)
+            with timer.stage("pickle figure"):
+                fig_bytes = _pickle_figure(fig)
+        finally:
+            plt.close(fig)
+    return fig_bytes, png, timer.record()
+
+@_closes_figures
+def export_task(fig_bytes, data, plot_args, fmt, dpi) -> bytes:
+    """
+    Runs in a worker. Saves a pickled figure as fmt, drawing it again from the data if
+    the session has no pickled copy (e.g. the plot came from the render cache).
+    """
+    import matplotlib.pyplot as plt
+    from utils import render_plot
+    from exports import save_figure
+    from perf import StageTimer, log_record
+    timer = StageTimer(f"export {fmt}")
+    if fig_bytes is not None:
+        fig = pickle.loads(fig_bytes)
+    else:
+        fig, _ = render_plot(_worker_dataset(data) if isinstance(data, str) else data, plot_args, timer=timer)
+    try:
+        with timer.stage(f"save {fmt}"):
+            exported = save_figure(fig, fmt, dpi)
+    finally:
+        plt.close(fig)
+    timer.count(bytes=len(exported))
+    log_record(timer.record(), keep=False)
+    return exported
+
+@_closes_figures
+def facet_task(data, plot_args, column, level, dpi):
+    """
+    Runs in a worker. Renders the panel of a faceted plot (see utils.render_facets) for
+    the rows where column is level. Returns (PNG, perf record).
+    """
+    from utils import render_facet_panel
+    from perf import StageTimer
+    timer = StageTimer("facet panel")
+    with timer.profiled():
+        with timer.stage("load data"):
+            df = _worker_dataset(data) if isinstance(data, str) else data
+        with timer.stage("select rows"):
+            df = df[(df[column] == level).to_numpy()]
+        png = render_facet_panel(df, plot_args, f"{column} = {level}", dpi, timer)
+    return png, timer.record()
+
+@_closes_figures
+def batch_task(data, plot_args, sample_rows, fmt, dpi, path):
+    """
+    Runs in a worker. Renders one plot of a batch (see batch_render) and saves it as fmt
+    to path, sampling sample_rows rows first if given. Returns its perf record.
+    """
+    import matplotlib.pyplot as plt
+    from utils import render_plot, plot_sample, facet_plan, render_facet_panel, facet_grid
+    from exports import save_figure
+    from sampling import MAX_STRATUM_LEVELS
+    from perf import StageTimer
+    timer = StageTimer("batch render")
+    with timer.profiled():
+        with timer.stage("load data"):
+            df = _worker_dataset(data) if isinstance(data, str) else data
+        if sample_rows:
+            with timer.stage("sample"):
+                strata_columns = [col for col in plot_args["var"] if df[col].nunique() <= MAX_STRATUM_LEVELS]
+                sampled, weight_col, sample = plot_sample(df, plot_args, sample_rows, strata_columns)
+            if sample is not None:
+                df, plot_args = sampled, dict(plot_args, weights=weight_col)
+        if plot_args.get("facet"):
+            # the batch already keeps every worker busy, so the panels are drawn one after another here
+            if fmt != "png":
+                raise ValueError("faceted plots can only be saved as PNG")
+            plan = facet_plan(df, plot_args)
+            column = plan["column"]
+            pngs = [render_facet_panel(df[(df[column] == level).to_numpy()], plan["args"], f"{column} = {level}", dpi, timer)
+                    for level in plan["levels"]]
+            with timer.stage("assemble grid"):
+                exported = facet_grid(pngs, plan["ncols"])
+        else:
+            fig, _ = render_plot(df, plot_args, timer=timer, png=False)
+            try:
+                with timer.stage(f"save {fmt}"):
+                    exported = save_figure(fig, fmt, dpi)
+            finally:
+                plt.close(fig)
+        with timer.stage("write file"):
+            with open(path, "wb") as f:
+                f.write(exported)
+    timer.count(bytes=len(exported))
+    return timer.record()
+
+def worker_pool(workers) -> ProcessPoolExecutor:
+    """
+    A pool of render worker processes, each replaced after WORKER_MAX_RENDERS tasks.
+    """
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker,
+                               max_tasks_per_child=WORKER_MAX_RENDERS)
+
+def gather(futures, combine) -> Future:
+    """
+    A future for combine(the results of futures, in order), called on a thread of its
+    own once they have all finished, so it doesn't hold up the pool's result handling.
+    It fails with the first of their errors, and is cancelled if any of them is.
+    """
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finish():
+        if not combined.set_running_or_notify_cancel():
+            return
+        if any(future.cancelled() for future in futures):
+            combined.set_exception(RuntimeError("The render was cancelled."))
+            return
+        try:
+            combined.set_result(combine([future.result() for future in futures]))
+        except Exception as e:
+            combined.set_exception(e)
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            threading.Thread(target=finish, daemon=True).start()
+
+    for future in futures:
+        future.add_done_callback(done)
+    if not futures:
+        threading.Thread(target=finish, daemon=True).start()
+    return combined
+
+class RenderService:
+    """
+    Queues renders from all sessions and hands them to the worker pool as workers free
+    up. Sessions take turns (round-robin), so one session queueing many renders doesn't
+    hold up the others, and the queue is bounded: past max_queued waiting renders, new
+    ones are refused with RenderQueueFull instead of piling up.
+    """
+    def __init__(self, workers=RENDER_WORKERS, max_queued=RENDER_QUEUE_SIZE):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.lock = threading.RLock()
+        self.queues = OrderedDict() # session id -> deque of (future, task, args), in turn order
+        self.running = 0
+        self.pool = None
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return worker_pool(self.workers)
+
+    def start(self):
+        """
+        Starts the workers ahead of the first render, so it doesn't wait for their imports.
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = self._new_pool()
+                for _ in range(self.workers):
+                    self.pool.submit(_noop)
+
+    def submit(self, session_id, task, *args) -> Future:
+        """
+        Queues task(*args) (one of the *_task functions above) and returns a future for its result.
+        """
+        with self.lock:
+            if sum(len(queue) for queue in self.queues.values()) >= self.max_queued:
+                raise RenderQueueFull("The server is busy with other plots right now, please try again in a moment.")
+            future = Future()
+            self.queues.setdefault(session_id, deque()).append((future, task, args))
+            self._dispatch()
+        return future
+
+    def cancel(self, session_id, future):
+        """
+        Drops a render that is still waiting. One that is already running is left to
+        finish, but its future's result can simply be ignored.
+        """
+        with self.lock:
+            queue = self.queues.get(session_id)
+            if queue is not None:
+                for job in queue:
+                    if job[0] is future:
+                        queue.remove(job)
+                        break
+                if not queue:
+                    del self.queues[session_id]
+        future.cancel()
+
+    def position(self, session_id, future):
+        """
+        Number of waiting renders that will start before this one, or None if it isn't
+        waiting any more.
+        """
+        with self.lock:
+            queue = self.queues.get(session_id)
+            index = next((i for i, job in enumerate(queue) if job[0] is future), None) if queue else None
+            if index is None:
+                return None
+            ahead = 0
+            before = True
+            for other_id, other in self.queues.items():
+                if other_id == session_id:
+                    before = False
+                    ahead += index
+                else:
+                    # sessions before this one in turn order get one more turn before it
+                    ahead += min(len(other), index + 1 if before else index)
+            return ahead
+
+    def _dispatch(self):
+        while self.running < self.workers and self.queues:
+            session_id, queue = next(iter(self.queues.items()))
+            future, task, args = queue.popleft()
+            # move the session to the back of the turn order
+            del self.queues[session_id]
+            if queue:
+                self.queues[session_id] = queue
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.pool is None:
+                self.pool = self._new_pool()
+            try:
+                pool_future = self.pool.submit(task, *args)
+            except (BrokenProcessPool, RuntimeError) as e:
+                self.pool = None
+                future.set_exception(e)
+                continue
+            self.running += 1
+            pool_future.add_done_callback(functools.partial(self._finished, future, self.pool))
+
+    def _finished(self, future, pool, pool_future):
+        error = pool_future.exception()
+        with self.lock:
+            self.running -= 1
+            if isinstance(error, BrokenProcessPool) and self.pool is pool:
+                # a worker died, e.g. killed for using too much memory; the next render gets a fresh pool
+                self.pool = None
+                pool.shutdown(wait=False)
+            self._dispatch()
+        if isinstance(error, BrokenProcessPool):
+            future.set_exception(RuntimeError("The plot ran out of resources while rendering. Try plotting fewer rows or columns."))
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(pool_future.result())
+
+@st.cache_resource(show_spinner=False)
+def get_render_service() -> RenderService:
+    """
+    The render service shared by every session on this server.
+    """
+    service = RenderService()
+    service.start()
+    return service
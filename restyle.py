@@ -0,0 +1,116 @@
+import matplotlib as mpl
+import matplotlib.colors as mcolors
+
+# Settings that only change how the drawn shapes look, not where they are. When nothing
+# else changed since the last render, the existing figure is recoloured instead of
+# running hammock's layout again.
+STYLE_ARGS = ["default_color", "colors", "alpha", "connector_color", "label_options"]
+BASIC_LABEL_OPTIONS = {"fontsize", "color"}
+FIXED_COLORS = {(0.0, 0.0, 0.0), (1.0, 1.0, 1.0)} # mean lines and dividers hammock always draws
+FIXED_ALPHA = 1.0 # ... and always draws opaque
+
+def style_only_change(old_args: dict, new_args: dict) -> bool:
+    """
+    True if new_args differ from old_args in style settings only.
+    """
+    return all(new_args[k] == old_args.get(k) for k in new_args if k not in STYLE_ARGS)
+
+def _rgb(color):
+    return tuple(float(c) for c in mcolors.to_rgb(color))
+
+def _palette(args):
+    return [args["default_color"]] + list(args["colors"] or [])
+
+def _color_map(old_args, new_args):
+    """
+    {old RGB: new RGB} for every colour hammock derives from the settings, or None if
+    two shapes that should change differently share a colour in the old figure.
+    """
+    old_palette, new_palette = _palette(old_args), _palette(new_args)
+    if len(old_palette) != len(new_palette):
+        return None
+    pairs = list(zip(old_palette, new_palette))
+    if (old_args["connector_color"] is None) != (new_args["connector_color"] is None):
+        return None # connectors switch between their own colour and the highlight colours
+    if old_args["connector_color"] is not None:
+        pairs.append((old_args["connector_color"], new_args["connector_color"]))
+    try:
+        # box plots outline each colour with a darker shade of it
+        from hammock_plot.utils import edge_color_from_face
+        pairs += [(edge_color_from_face(old), edge_color_from_face(new)) for old, new in pairs]
+    except ImportError:
+        if any(t in ("box", "violin") for t in (old_args["display_type"] or {}).values()):
+            return None
+
+    color_map = {}
+    for old, new in pairs:
+        old_rgb, new_rgb = _rgb(old), _rgb(new)
+        if old_rgb in FIXED_COLORS or color_map.get(old_rgb, new_rgb) != new_rgb:
+            return None
+        color_map[old_rgb] = new_rgb
+    return color_map
+
+def _recolor(artist, color_map, old_alpha, new_alpha):
+    if hasattr(artist, "get_facecolors"): # collections hold one colour per element
+        for get, set_ in [(artist.get_facecolors, artist.set_facecolor), (artist.get_edgecolors, artist.set_edgecolor)]:
+            colors = get()
+            if len(colors):
+                set_([color_map.get(tuple(float(c) for c in rgba[:3]), tuple(rgba[:3])) + (rgba[3],) for rgba in colors])
+    elif hasattr(artist, "get_facecolor"):
+        for get, set_ in [(artist.get_facecolor, artist.set_facecolor), (artist.get_edgecolor, artist.set_edgecolor)]:
+            rgb = _rgb(get())
+            if rgb in color_map:
+                set_(color_map[rgb])
+    else:
+        rgb = _rgb(artist.get_color())
+        if rgb in color_map:
+            artist.set_color(color_map[rgb])
+    if artist.get_alpha() is not None and artist.get_alpha() == old_alpha:
+        artist.set_alpha(new_alpha)
+
+def _default_text_style(tick_label):
+    if tick_label:
+        color = mpl.rcParams["xtick.labelcolor"]
+        return {"fontsize": mpl.rcParams["xtick.labelsize"],
+                "color": mpl.rcParams["xtick.color"] if color == "inherit" else color}
+    return {"fontsize": mpl.rcParams["font.size"], "color": mpl.rcParams["text.color"]}
+
+def _restyle_labels(ax, old_args, new_args) -> bool:
+    old_options, new_options = old_args["label_options"] or {}, new_args["label_options"] or {}
+    var = list(old_args["var"])
+    ticks = list(ax.get_xticks())
+    if len(ticks) != len(var):
+        return False
+    for i, uni in enumerate(var):
+        old, new = old_options.get(uni) or {}, new_options.get(uni) or {}
+        if old == new:
+            continue
+        if not set(old) <= BASIC_LABEL_OPTIONS or not set(new) <= BASIC_LABEL_OPTIONS:
+            return False
+        # a unibar's value labels are centred on it, and its name is the tick below it
+        for text in [t for t in ax.texts if t.get_position()[0] == ticks[i]]:
+            text.set(**{**_default_text_style(False), **new})
+        ax.get_xticklabels()[i].set(**{**_default_text_style(True), **new})
+    return True
+
+def restyle_figure(fig, old_args: dict, new_args: dict) -> bool:
+    """
+    Updates the colours, opacity and label styles of a hammock figure drawn with
+    old_args to match new_args, which differ from them in style settings only.
+    Returns False, leaving the figure half-updated, if the shapes to change can't be
+    told apart; the plot then needs a full render.
+    """
+    if new_args["default_color"] in (new_args["colors"] or []):
+        return False # hammock rejects this, let the full render say so
+    old_alpha, new_alpha = old_args["alpha"], new_args["alpha"]
+    if old_alpha != new_alpha and old_alpha == FIXED_ALPHA:
+        return False
+    color_map = _color_map(old_args, new_args)
+    if color_map is None or len(fig.axes) != 1:
+        return False
+    ax = fig.axes[0]
+    for artist in list(ax.patches) + list(ax.collections) + list(ax.lines):
+        _recolor(artist, color_map, old_alpha, new_alpha)
+    if old_args["label_options"] != new_args["label_options"]:
+        return _restyle_labels(ax, old_args, new_args)
+    return True
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+SAMPLE_ROWS = 100_000
+MAX_STRATUM_LEVELS = 50 # unibars with at most this many distinct values are sampled value by value
+MIN_STRATUM_ROWS = 2 # rows kept from every stratum however rare; two so its variance can be estimated
+SAMPLE_WEIGHT_COLUMN = "hammock_sample_weight"
+
+def combine_keys(keys) -> np.ndarray:
+    """
+    Stratum number of each row: one stratum per distinct combination of the keys
+    (missing values included).
+    """
+    strata = None
+    for key in keys:
+        codes, uniques = pd.factorize(key, use_na_sentinel=False)
+        if strata is None:
+            strata = codes
+        else:
+            strata, _ = pd.factorize(strata * len(uniques) + codes)
+    return strata
+
+def stratified_sample(df: pd.DataFrame, keys, weights, n, seed=0):
+    """
+    Samples about n rows of df, stratified by the combinations of keys, and weights each
+    row so that every stratum keeps its full total. Every stratum, however rare, keeps at
+    least MIN_STRATUM_ROWS rows. Returns (sample, weight column, report), or
+    (df, weights, None) if df has no more than n rows.
+
+    The report gives the sample size, the number of strata and a 95% bound on the error
+    of any bar proportion of a column that isn't one of the keys (those are exact).
+    """
+    total = len(df)
+    if total <= n:
+        return df, weights, None
+
+    strata = combine_keys(keys) if keys else np.zeros(total, dtype=np.int64)
+    sizes = np.bincount(strata)
+    allocated = np.minimum(sizes, np.maximum(MIN_STRATUM_ROWS, np.round(n * sizes / total).astype(np.int64)))
+
+    # shuffle within strata and keep the first `allocated` rows of each
+    rng = np.random.default_rng(seed)
+    order = np.argsort(strata + rng.random(total)) # stratum, then random order within it
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    rank = np.arange(total) - starts[strata[order]]
+    chosen = np.sort(order[rank < allocated[strata[order]]])
+    chosen_strata = strata[chosen]
+
+    if weights is None:
+        row_weights = (sizes / allocated)[chosen_strata]
+    else:
+        user_weights = df[weights].to_numpy(dtype="float64")
+        full = np.bincount(strata, weights=user_weights)
+        sampled = np.bincount(chosen_strata, weights=user_weights[chosen], minlength=len(sizes))
+        row_weights = user_weights[chosen] * (full / sampled)[chosen_strata]
+
+    weight_col = SAMPLE_WEIGHT_COLUMN
+    while weight_col in df.columns:
+        weight_col = "_" + weight_col
+    sample = df.iloc[chosen].assign(**{weight_col: row_weights})
+
+    # worst case (p = 0.5) standard error of a stratified estimate of a proportion
+    shares = sizes / total
+    variance = np.sum(shares**2 * (1 - allocated / sizes) * 0.25 / np.maximum(allocated - 1, 1))
+    report = {"rows": len(sample), "total": total, "strata": len(sizes), "max_error": 1.96 * float(np.sqrt(variance))}
+    return sample, weight_col, report
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from utils import aggregate_for_plot, AGGREGATE_WEIGHT_COLUMN
+
+def weighted_frame():
+    return pd.DataFrame({"a": ["x", "y", "x", "x", "y", "x"], "w": [1, 2, 1, 2, 2, 1]})
+
+def test_highlight_on_weight_column():
+    df = weighted_frame()
+    plot_df, weights = aggregate_for_plot(df, ["a"], "w", "w", {})
+    assert weights == AGGREGATE_WEIGHT_COLUMN
+    # grouped on the weight values, each group summing them
+    totals = plot_df.set_index(["a", "w"])[weights]
+    assert totals[("x", 1)] == 3 and totals[("x", 2)] == 2 and totals[("y", 2)] == 4
+    assert plot_df[weights].sum() == df["w"].sum()
+
+def test_weight_column_plotted():
+    df = weighted_frame()
+    plot_df, weights = aggregate_for_plot(df, ["a", "w"], None, "w", {})
+    assert weights not in ["a", "w"]
+    assert list(plot_df.columns) == ["a", "w", weights]
+    assert plot_df[weights].sum() == df["w"].sum()
+
+def test_weight_column_name_taken():
+    df = weighted_frame().rename(columns={"a": AGGREGATE_WEIGHT_COLUMN})
+    plot_df, weights = aggregate_for_plot(df, [AGGREGATE_WEIGHT_COLUMN], None, "w", {})
+    assert weights == "_" + AGGREGATE_WEIGHT_COLUMN
+    assert np.isclose(plot_df[weights].sum(), df["w"].sum())
@@ -0,0 +1,16 @@
+import pytest
+
+from batch_render import check_name, check_spec
+
+@pytest.mark.parametrize("name", ["../escaped", "a/b", "a\\b", "..", ".hidden", "", "/tmp/x"])
+def test_unsafe_names_rejected(name):
+    with pytest.raises(ValueError, match="invalid name"):
+        check_name(name)
+
+@pytest.mark.parametrize("name", ["penguins", "my plot-2", "v1.2_final"])
+def test_safe_names_pass(name):
+    check_name(name)
+
+def test_check_spec_rejects_spec_name():
+    with pytest.raises(ValueError, match="invalid name"):
+        check_spec({"name": "../escaped", "plot": {}}, [])
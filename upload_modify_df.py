@@ -1,6 +1,22 @@
 import streamlit as st
 import pandas as pd
 
+from column_profile import set_dataframe, clear_dataframe
+from dataset_store import put_dataset, open_dataset, rename_op, replace_op, describe_op
+from edit_log import get_edit_log, edit_dataframe
+from data_preview import data_preview
+from perf import StageTimer, log_record
+from exports import DATA_FORMATS, export_files, deferred, data_bytes
+from data_loading import (
+    UPLOAD_TYPES,
+    file_format,
+    read_csv_chunked,
+    columnar_columns,
+    read_columnar,
+    compact_dtypes,
+    memory_report,
+)
+
 @st.dialog("Choose Column to Rename")
 def rename_column():
     df = st.session_state.df
@@ -8,88 +24,140 @@ def rename_column():
     new_name = st.text_input("As:")
 
     if st.button("Rename Column"):
-        # Get the column order
-        cols = list(df.columns)
-        idx = cols.index(column_to_rename)
-        # Replace the old column name with the new one in the same position
-        cols[idx] = new_name
-        # Rename and reorder
-        df = df.rename(columns={column_to_rename: new_name})[cols]
-        # Save back to session state
-        st.session_state.df = df
+        # Rename in place of the old name, on a shallow copy - the column data isn't copied,
+        # and the column's profile moves over unchanged
+        edit_dataframe(rename_op(column_to_rename, new_name))
         st.rerun()
 
-def update_uniquevals_weightvars():
-    st.session_state.possible_weightvars = set()
-    for col in st.session_state.df.columns:
-        key_name = f"col_{col}_uniquevals"
-        st.session_state[key_name] = st.session_state.df[col].unique()
-
-        column = st.session_state.df[col]
-        
-        if pd.api.types.is_numeric_dtype(column) and not column.isna().any() and not (column <= 0).any():
-            st.session_state.possible_weightvars.add(col)
-
 @st.dialog("Choose Labels to Replace")
 def replace_column_values():
     col =  st.selectbox(label="Replace labels from column:", options=list(st.session_state.df))
-    old_name = st.selectbox("Replace:", options=list(st.session_state.df[col].unique()) if col else [])
+    profile = st.session_state.profile[col] if col else None
+    if profile is not None and profile.unique_values is None:
+        # high-cardinality column: offer the most frequent labels
+        st.caption(f"{profile.describe_uniques()}, showing the most frequent")
+        options = list(profile.top_values.index)
+    else:
+        options = list(profile.unique_values) if profile is not None else []
+    old_name = st.selectbox("Replace:", options=options)
     new_name = st.text_input("With:")
     if st.button("Replace All"):
-        st.session_state.df[col] = st.session_state.df[col].replace(old_name, new_name)
+        edit_dataframe(replace_op(col, old_name, new_name))
         st.rerun()
 
+def load_dataframe(df: pd.DataFrame, timer: StageTimer):
+    """
+    Stores newly loaded data, compacting its dtypes first if the user asked for it.
+    timer has timed reading the data; the rest of the load is added to it and logged.
+    """
+    timer.count(rows=len(df), columns=len(df.columns))
+    if st.session_state.get("compact_dtypes", True):
+        with st.spinner("Compacting data types..."), timer.stage("compact dtypes"):
+            compacted = compact_dtypes(df)
+            st.session_state.memory_report = memory_report(df, compacted)
+            df = compacted
+    else:
+        st.session_state.memory_report = None
+    with st.spinner("Saving to the dataset store..."), timer.stage("store"):
+        # sessions opening the same data share one memory-mapped copy
+        dataset_id = put_dataset(df)
+        if dataset_id is not None:
+            df = open_dataset(dataset_id)
+            st.query_params["dataset"] = dataset_id
+    st.session_state.dataset_id = dataset_id
+    with st.spinner("Profiling columns..."), timer.stage("profile columns"):
+        set_dataframe(df)
+    log_record(timer.record())
+
 st.header("Upload/Modify Your Data")
 
 if "df" not in st.session_state:
+    st.checkbox(label="Compact data types", value=True, key="compact_dtypes",
+                help="Store low-cardinality text as categories and use the smallest numeric types that hold the exact values. Uses much less memory; plots are unchanged.")
     if st.button(label="Use [Palmer penguins data](https://allisonhorst.github.io/palmerpenguins/)"):
-        df = pd.read_csv("./data/palmer_penguins.csv")
-        st.session_state.df = df
-        update_uniquevals_weightvars()
+        timer = StageTimer("load")
+        with timer.stage("read"):
+            df = pd.read_csv("./data/palmer_penguins.csv")
+        load_dataframe(df, timer)
         st.rerun()
     else:
         uploaded_file = st.file_uploader(
             label="Upload your own data",
-            type=["csv"] # add anything else that may be accepted (dta?)
+            type=UPLOAD_TYPES # add anything else that may be accepted (dta?)
         )
         if uploaded_file is not None:
-            # Read the CSV into a pandas DataFrame
-            df = pd.read_csv(uploaded_file)
-            
-            # Store the DataFrame in session_state
-            if "df" not in st.session_state or st.session_state.df != df:
-                st.session_state.df = df
-                update_uniquevals_weightvars()
-            
-            
-            st.rerun()
+            fmt = file_format(uploaded_file.name)
+            if fmt == "csv":
+                # Read the CSV into a pandas DataFrame chunk by chunk
+                progress = st.progress(0.0, text=f"Reading {uploaded_file.name}...")
+                timer = StageTimer("load")
+                with timer.stage("parse csv"):
+                    df = read_csv_chunked(uploaded_file, on_progress=lambda fraction: progress.progress(
+                        fraction, text=f"Reading {uploaded_file.name}... {fraction:.0%}"))
+                load_dataframe(df, timer)
+                st.rerun()
+            else:
+                # columnar files: only read the columns that will be used
+                columns = columnar_columns(uploaded_file, fmt)
+                selected_columns = st.multiselect(label="Columns to load", options=columns, default=columns)
+                if st.button("Load data", type="primary", disabled=not selected_columns):
+                    timer = StageTimer("load")
+                    with st.spinner(f"Reading {len(selected_columns)} columns..."), timer.stage(f"read {fmt}"):
+                        df = read_columnar(uploaded_file, fmt, selected_columns)
+                    load_dataframe(df, timer)
+                    st.rerun()
 else:
-    st.dataframe(st.session_state.df)
+    data_preview("data_preview")
+
+    report = st.session_state.get("memory_report")
+    if report is not None:
+        total = report.loc["total"]
+        with st.expander(f"Memory: {total['MB before']:.1f} MB → {total['MB after']:.1f} MB after compacting data types"):
+            st.dataframe(report, column_config={
+                "MB before": st.column_config.NumberColumn(format="%.2f"),
+                "MB after": st.column_config.NumberColumn(format="%.2f"),
+            })
 
     col1, col2, col3, col4 = st.columns([1, 1, 1, 1])
 
     if col1.button("Rename Column", use_container_width=True):
         rename_column()
-        update_uniquevals_weightvars()
 
     if col2.button("Replace Labels", use_container_width=True):
         replace_column_values()
-        update_uniquevals_weightvars()
+
+    log = get_edit_log()
+    undocol, redocol, _ = st.columns([1, 1, 2])
+    if undocol.button("Undo", icon=":material/undo:", disabled=not log.can_undo(), use_container_width=True,
+                      help=f"Undo {describe_op(log.ops[log.position - 1])}" if log.can_undo() else None):
+        log.undo()
+        st.rerun()
+    if redocol.button("Redo", icon=":material/redo:", disabled=not log.can_redo(), use_container_width=True,
+                      help=f"Redo {describe_op(log.ops[log.position])}" if log.can_redo() else None):
+        log.redo()
+        st.rerun()
 
     # allow user to clear data
     with col3:
-        st.download_button(
-            label="Save Local",
-            data=st.session_state.df.to_csv().encode("utf-8"),
-            file_name="hammock-plot-data.csv",
-            mime="text/csv",
-            icon=":material/download:",
-            use_container_width=True,
-        )
+        with st.popover("Save Local", icon=":material/download:", use_container_width=True):
+            export_format = st.selectbox("Format", list(DATA_FORMATS), key="data_export_format")
+            ext, mime = DATA_FORMATS[export_format]
+            files = export_files("data_exports", st.session_state.get("data_version", 0))
+            df = st.session_state.df
+            st.download_button(
+                label=f"Download as {export_format}",
+                data=deferred(files, ext, lambda: data_bytes(df, ext)), # only serialized when clicked
+                file_name=f"hammock-plot-data.{ext}",
+                mime=mime,
+                icon=":material/download:",
+                use_container_width=True,
+            )
 
     with col4:
         if st.button("Clear data", use_container_width=True):
-            del st.session_state["df"]
+            clear_dataframe()
+            st.session_state.dataset_id = None
+            st.query_params.pop("dataset", None)
             st.rerun()
     
     if st.button("Continue to hammock settings", type="primary"):
@@ -1,15 +1,502 @@
 import io
+import ast
+import json
+import hashlib
+import functools
+import warnings
+import copy
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 import streamlit as st
 import re
 import hammock_plot
 import pandas as pd
 import numpy as np
 
-def prep_data_for_download():
+from column_profile import get_profile
+from render_service import get_render_service, render_task, restyle_task, draft_task, export_task, facet_task, gather, RenderQueueFull
+from exports import deferred
+from figure_store import SessionFigures, figure_budget
+from sampling import stratified_sample, MAX_STRATUM_LEVELS
+from restyle import style_only_change
+from perf import StageTimer, log_record
+
+RENDER_CACHE_MAX_ENTRIES = 64
+RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class RenderCache:
+    """
+    LRU cache of rendered PNG bytes shared by every session, keyed on
+    (data fingerprint, hash of the plot() arguments). Bounded both by entry
+    count and by total bytes; the least recently used renders go first.
+    """
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            png = self._entries.get(key)
+            if png is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return png
+
+    def put(self, key, png: bytes):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= len(self._entries.pop(key))
+            self._entries[key] = png
+            self._nbytes += len(png)
+            while len(self._entries) > self.max_entries or self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._nbytes}
+
+render_cache = RenderCache()
+
+def fingerprint_df(df: pd.DataFrame) -> str:
+    """
+    Content hash of a dataframe: values, index, column names and dtypes.
+    """
+    h = hashlib.sha256()
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    h.update(repr(list(df.columns)).encode("utf-8"))
+    h.update(repr([str(dtype) for dtype in df.dtypes]).encode("utf-8"))
+    return h.hexdigest()
+
+def data_fingerprint() -> str:
+    """
+    Fingerprint of st.session_state.df, computed once per data version.
+    """
+    version = st.session_state.get("data_version", 0)
+    cached = st.session_state.get("df_fingerprint")
+    if cached is None or cached[0] != version:
+        cached = (version, fingerprint_df(st.session_state.df))
+        st.session_state.df_fingerprint = cached
+    return cached[1]
+
+def hash_plot_args(plot_args: dict) -> str:
+    """
+    Canonical hash of the plot() arguments. Dict keys are sorted, list order is kept
+    (it matters for var, colors and value orders).
+    """
+    canonical = json.dumps(plot_args, sort_keys=True, default=repr)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+AGGREGATE_WEIGHT_COLUMN = "hammock_row_count"
+AGGREGATE_MAX_RATIO = 0.5 # only aggregate if it at least halves the number of rows
+
+def aggregate_for_plot(df: pd.DataFrame, var, hi_var, weights, display_type, violin_bw_method=None):
+    """
+    Collapses the rows of df into the unique combinations of the plotted variables
+    (and hi_var), with a weight column holding the number of rows - or the sum of the
+    user's weight variable - for each combination. Returns (df, weights) to pass to Hammock.
+
+    Bars, box plots and rugplots only depend on the weight of each distinct value, so
+    numeric columns are grouped on their exact values. Violins are only aggregated if
+    violin_bw_method is a number: a "scott" or "silverman" bandwidth depends on the
+    number of observations, so the full frame is used (see violin_bandwidth). The full
+    frame is also used if collapsing would not shrink it much.
+    """
+    if any(display_type.get(v) == "violin" for v in var) and isinstance(violin_bw_method, str):
+        return df, weights
+
+    keys = list(var) + ([hi_var] if hi_var and hi_var not in var else [])
+    # a column of its own, as the weight variable may also be plotted or highlighted
+    weight_col = AGGREGATE_WEIGHT_COLUMN
+    while weight_col in keys:
+        weight_col = "_" + weight_col
+    if weights:
+        # sum in 64 bits so small integer dtypes can't overflow
+        wide_dtype = "int64" if pd.api.types.is_integer_dtype(df[weights]) else "float64"
+        counts = df[keys].assign(**{weight_col: df[weights].astype(wide_dtype)}) \
+            .groupby(keys, dropna=False, observed=True, sort=False)[weight_col].sum()
+    else:
+        counts = df.groupby(keys, dropna=False, observed=True, sort=False).size()
+
+    if len(counts) > len(df) * AGGREGATE_MAX_RATIO:
+        return df, weights
+    return counts.rename(weight_col).reset_index(), weight_col
+
+def restore_plot_dtypes(df: pd.DataFrame, columns):
+    """
+    Turns compacted categorical columns back into plain values for Hammock, which fills
+    missing values with a placeholder label that isn't one of the categories.
+    """
+    restored = {col: df[col].astype(df[col].cat.categories.dtype)
+                for col in dict.fromkeys(columns) if col and isinstance(df[col].dtype, pd.CategoricalDtype)}
+    return df.assign(**restored) if restored else df
+
+def figure_to_png(fig, dpi=None) -> bytes:
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=dpi, bbox_inches="tight")
+    return buf.getvalue()
+
+def coarsen_numeric(df: pd.DataFrame, columns, levels) -> pd.DataFrame:
+    """
+    Snaps each numeric column with more than `levels` distinct values to `levels` evenly
+    spaced values between its min and max. Hammock draws a connector per pair of
+    distinct values, so this is what makes a draft of a high-cardinality column quick.
+    """
+    coarse = {}
+    for col in dict.fromkeys(columns):
+        column = df[col]
+        if not pd.api.types.is_numeric_dtype(column.dtype) or pd.api.types.is_bool_dtype(column.dtype):
+            continue
+        if column.nunique() <= levels:
+            continue
+        lo, hi = column.min(), column.max()
+        step = (hi - lo) / (levels - 1)
+        coarse[col] = lo + ((column - lo) / step).round() * step
+    return df.assign(**coarse) if coarse else df
+
+LARGE_N_ROWS = 100_000 # rugplots and violins of more rows than this are drawn from binned values
+LARGE_N_LEVELS = 1024 # distinct positions kept per rugplot or violin, about the plot's pixel height
+
+def violin_bandwidth(df: pd.DataFrame, column, weights, bw_method):
+    """
+    The KDE bandwidth factor that bw_method ("scott" or "silverman") gives hammock's
+    violin of column, computed the way it gets there: scipy's rule over each distinct
+    value repeated round(frequency / lowest frequency) times, a value's frequency being
+    its count, or its weight sum with weights. A number is returned as it is.
+    """
+    if not isinstance(bw_method, str):
+        return bw_method
+    values = df[column]
+    present = values.notna().to_numpy()
+    if weights:
+        frequency = df[weights][present].groupby(values[present].to_numpy()).sum()
+    else:
+        frequency = values[present].value_counts()
+    n = np.round(frequency / frequency.min()).sum() if len(frequency) else 0
+    if bw_method == "silverman":
+        n = n * 3 / 4
+    return float(max(n, 1) ** (-1 / 5))
+
+def thin_large_n(df: pd.DataFrame, args):
+    """
+    Snaps the values of large rugplot and violin unibars to LARGE_N_LEVELS positions,
+    so repeated ticks are drawn once with their combined weight and the violin density
+    is estimated over binned values. Returns (df, violin_bw_method).
+    Binning changes the value frequencies scipy's bandwidth rule sees, so the bandwidth
+    of the full data is fixed beforehand - but hammock takes one bandwidth for every
+    violin, so only when that one fits them all: not when highlighting splits violins
+    into colour halves (each is estimated on its own rows), nor when the violins'
+    bandwidths differ. Then the bandwidth rule is left to apply to the binned values.
+    """
+    display_type = args["display_type"] or {}
+    columns = [col for col in args["var"] if display_type.get(col) in ("rugplot", "violin")
+               and col != args["hi_var"] and not (args["value_order"] or {}).get(col)]
+    bw_method = args["violin_bw_method"]
+    if len(df) < LARGE_N_ROWS or not columns:
+        return df, bw_method
+    violins = [col for col in columns if display_type[col] == "violin"]
+    if violins and not args["hi_var"]:
+        bandwidths = {violin_bandwidth(df, col, args["weights"], bw_method) for col in violins}
+        if len(bandwidths) == 1:
+            bw_method = bandwidths.pop()
+    return coarsen_numeric(df, columns, LARGE_N_LEVELS), bw_method
+
+MAX_CATEGORICAL_LEVELS = 30 # categorical unibars with more labels than this are binned or capped by default
+DEFAULT_BINS = 10
+DEFAULT_TOP_N = 20
+OTHER_LABEL = "Other"
+BIN_METHODS = ["quantile", "equal width", "custom breaks"]
+
+def bin_edges(column: pd.Series, spec) -> np.ndarray:
+    """
+    Bin edges for a numeric column: spec["bins"] quantile or equal width bins, the
+    custom spec["breaks"] with the column's min and max added on either side, or
+    exactly spec["edges"] (see shared_binning).
+    """
+    if spec["method"] == "edges":
+        return np.asarray(spec["edges"], dtype="float64")
+    values = column.to_numpy(dtype="float64", na_value=np.nan)
+    lo, hi = np.nanmin(values), np.nanmax(values)
+    if spec["method"] == "quantile":
+        edges = np.nanquantile(values, np.linspace(0, 1, spec["bins"] + 1))
+    elif spec["method"] == "equal width":
+        edges = np.linspace(lo, hi, spec["bins"] + 1)
+    else:
+        edges = [lo] + [b for b in spec["breaks"] if lo < b < hi] + [hi]
+    return np.unique(edges)
+
+def bin_numeric(column: pd.Series, spec):
+    """
+    Bins a numeric column into labelled intervals (see bin_edges). Returns the binned
+    column and its labels in order, or (column, None) if it has fewer than two values.
+    """
+    if column.notna().sum() == 0:
+        return column, None
+    edges = bin_edges(column, spec)
+    if len(edges) < 2:
+        return column, None
+    formatted = get_formatted_values(pd.Series(edges))
+    labels = [f"{a} to {b}" for a, b in zip(formatted[:-1], formatted[1:])]
+    if len(set(labels)) < len(labels):
+        labels = [f"{a:.6g} to {b:.6g}" for a, b in zip(edges[:-1], edges[1:])]
+    if len(set(labels)) < len(labels):
+        labels = [f"{a!r} to {b!r}" for a, b in zip(edges[:-1], edges[1:])]
+    binned = pd.cut(column.astype("float64"), edges, labels=labels, include_lowest=True)
+    return binned, labels
+
+def cap_categories(column: pd.Series, n, keep=None):
+    """
+    Keeps the n most frequent labels of a column (or the labels in keep) and collapses
+    the rest into OTHER_LABEL. Returns the capped column and the kept labels, most
+    frequent first.
+    """
+    top = pd.Index(keep) if keep is not None else column.value_counts(dropna=True).index[:n]
+    values = column.astype(object)
+    other = values.notna() & ~values.isin(top)
+    if not other.any():
+        return column, list(top)
+    return values.mask(other, OTHER_LABEL), list(top) + [OTHER_LABEL]
+
+def apply_binning(df: pd.DataFrame, binning, value_order):
+    """
+    Bins the numeric unibars and caps the categorical ones in binning ({unibar: spec},
+    spec["method"] one of BIN_METHODS or "top" with spec["n"] labels kept), so that
+    the number of bars and connectors stays small however many distinct values the
+    columns have. Returns (df, value_order) with the value orders of the binned unibars
+    replaced by their bins, or for capped ones, filtered to the labels kept.
+    """
+    if not binning:
+        return df, value_order
+    value_order = dict(value_order or {})
+    binned = {}
+    for col, spec in binning.items():
+        if spec["method"] == "top":
+            binned[col], labels = cap_categories(df[col], spec["n"], spec.get("labels"))
+            if value_order.get(col):
+                labels = [label for label in value_order[col] if label in labels] + \
+                         ([OTHER_LABEL] if OTHER_LABEL in labels and OTHER_LABEL not in value_order[col] else [])
+                value_order[col] = labels
+        else:
+            column, labels = bin_numeric(df[col], spec)
+            if labels is not None:
+                binned[col], value_order[col] = column, labels
+    return df.assign(**binned), value_order
+
+def shared_binning(df: pd.DataFrame, binning):
+    """
+    binning with each spec fixed to the bins or kept labels it gives for the whole of
+    df, so that subsets of df (facet panels) are binned alike.
+    """
+    shared = {}
+    for col, spec in (binning or {}).items():
+        if spec["method"] == "top":
+            shared[col] = dict(spec, labels=list(df[col].value_counts(dropna=True).index[:spec["n"]]))
+        elif df[col].notna().any():
+            shared[col] = {"method": "edges", "edges": bin_edges(df[col], spec).tolist()}
+    return shared
+
+def render_plot(df: pd.DataFrame, plot_args: dict, dpi=None, draft_levels=None, timer=None, png=True):
+    """
+    Renders a hammock plot of df with the plot() arguments, without touching session
+    state, so it can run in a render worker. Returns (figure, PNG bytes at dpi), or
+    (figure, None) with png=False.
+    With draft_levels, numeric unibars are coarsened to that many values first.
+    The stages are timed with timer (a perf.StageTimer) if one is given.
+    """
+    timer = timer or StageTimer("render")
+    args = dict(plot_args)
+    args.pop("facet", None) # panels are split off before they get here (see render_facets)
+    binning = args.pop("binning", None)
+    large_n = args.pop("large_n", False)
+    timer.count(rows=len(df), unibars=len(args["var"]))
+    with timer.stage("prepare data"):
+        plot_df, args["hi_var"], args["hi_value"] = resolve_highlight_expression(
+            df, args["hi_var"], args["hi_value"], args["hi_missing"], args["missing_placeholder"])
+        if binning and args["hi_var"] in binning:
+            # highlight on the original labels, which the binned unibar no longer has
+            highlight_col = HIGHLIGHT_COLUMN
+            while highlight_col in plot_df.columns:
+                highlight_col = "_" + highlight_col
+            plot_df = plot_df.assign(**{highlight_col: plot_df[args["hi_var"]]})
+            args["hi_var"] = highlight_col
+        plot_df, args["value_order"] = apply_binning(plot_df, binning, args["value_order"])
+        if large_n:
+            plot_df, args["violin_bw_method"] = thin_large_n(plot_df, args)
+        if draft_levels:
+            # leave alone the columns whose values are matched exactly: custom orders and highlighting
+            plot_df = coarsen_numeric(plot_df, [col for col in args["var"]
+                                                if col != args["hi_var"] and not (args["value_order"] or {}).get(col)], draft_levels)
+    with timer.stage("aggregate"):
+        plot_df, args["weights"] = aggregate_for_plot(plot_df, args["var"], args["hi_var"], args["weights"],
+                                                      args["display_type"], args["violin_bw_method"])
+        plot_df = restore_plot_dtypes(plot_df, list(args["var"]) + [args["hi_var"]])
+    # rows hammock draws from: one per combination of the plotted values if aggregated
+    timer.count(plotted_rows=len(plot_df))
+
+    with timer.stage("hammock plot"):
+        hammock = hammock_plot.Hammock(data_df=plot_df)
+        ax = hammock.plot(**args, display_figure=True, save_path=None)
+    fig = ax.get_figure()
+    timer.count(shapes=len(fig.axes[0].patches) + len(fig.axes[0].collections) if fig.axes else 0)
+
+    if not png:
+        return fig, None
+    with timer.stage("savefig"):
+        png = figure_to_png(fig, dpi)
+    timer.count(png_bytes=len(png))
+    return fig, png
+
+MAX_FACETS = 24 # panels in a faceted plot, each is a full render
+DEFAULT_FACET_COLUMNS = 3
+
+def facet_levels(values) -> list:
+    """
+    The panels of a plot faceted on a column with these distinct values: one per
+    value, sorted, leaving out missing values.
+    """
+    return pd.Series(values).dropna().drop_duplicates().sort_values().tolist()
+
+def facet_plan(df: pd.DataFrame, plot_args, levels=None) -> dict:
+    """
+    How to draw the plot_args["facet"] = {"column", "ncols"} panels of df: the plot
+    arguments every panel shares, the facet column, its levels and the panels per row.
+    Binning and the labels of categorical unibars are fixed from the whole of df, so
+    every panel has the same bins and bar order (unibars in same_scale share their
+    scale within each panel as usual). Numeric scales follow each panel's own range.
+    """
+    facet = plot_args["facet"]
+    column = facet["column"]
+    levels = facet_levels(df[column].unique()) if levels is None else levels
+    if not levels:
+        raise ValueError(f"{column} has no values to facet on")
+    if len(levels) > MAX_FACETS:
+        raise ValueError(f"{column} has {len(levels)} values, at most {MAX_FACETS} panels can be drawn")
+    args = dict(plot_args, facet=None)
+    args["binning"] = shared_binning(df, args.get("binning"))
+    value_order = dict(args["value_order"] or {})
+    for col in args["var"]:
+        if value_order.get(col):
+            continue
+        spec = args["binning"].get(col)
+        if spec is not None:
+            if spec["method"] == "top":
+                value_order[col] = list(spec["labels"]) + [OTHER_LABEL]
+        elif not pd.api.types.is_numeric_dtype(df[col]):
+            # hammock's own default order, the order of appearance, but over all the rows
+            value_order[col] = get_formatted_values(pd.Series(df[col].dropna().unique()))
+    args["value_order"] = value_order
+    return {"args": args, "column": column, "levels": levels, "ncols": facet.get("ncols") or DEFAULT_FACET_COLUMNS}
+
+def render_facet_panel(df: pd.DataFrame, plot_args, title, dpi=None, timer=None) -> bytes:
+    """
+    PNG of one facet panel: the plot of df's rows with a title over it.
+    """
+    import matplotlib.pyplot as plt
+    timer = timer or StageTimer("facet panel")
+    # hammock trims value_order to the panel's labels in place, and the panels share it
+    fig, _ = render_plot(df, copy.deepcopy(plot_args), timer=timer, png=False)
+    try:
+        fig.suptitle(f"{title} ({len(df):,} rows)", fontsize=20)
+        with timer.stage("savefig"):
+            return figure_to_png(fig, dpi)
+    finally:
+        plt.close(fig)
+
+def facet_grid(pngs, ncols) -> bytes:
+    """
+    One PNG with the panel PNGs laid out ncols to a row, each centred in a cell the
+    size of the largest.
+    """
+    from PIL import Image # comes with matplotlib
+    images = [Image.open(io.BytesIO(png)).convert("RGB") for png in pngs]
+    width = max(image.width for image in images)
+    height = max(image.height for image in images)
+    ncols = min(ncols, len(images))
+    nrows = -(-len(images) // ncols)
+    grid = Image.new("RGB", (width * ncols, height * nrows), "white")
+    for i, image in enumerate(images):
+        row, col = divmod(i, ncols)
+        grid.paste(image, (col * width + (width - image.width) // 2, row * height + (height - image.height) // 2))
     buf = io.BytesIO()
-    st.session_state.fig.savefig(buf, format="png", bbox_inches="tight")
-    buf.seek(0)
-    st.session_state.buf = buf
+    grid.save(buf, format="PNG", compress_level=1) # big image; fast to encode beats a few bytes less
+    return buf.getvalue()
+
+def render_facets(service, session_id, data, plan, dpi=None):
+    """
+    Queues a render of each facet panel in plan (see facet_plan) with the render
+    service, which spreads them over the workers. Returns (future for (None, grid PNG,
+    perf record) once they're all done, the panels' futures).
+    """
+    start = time.perf_counter()
+    panels = []
+    try:
+        for level in plan["levels"]:
+            panels.append(service.submit(session_id, facet_task, data, plan["args"], plan["column"], level, dpi))
+    except RenderQueueFull:
+        for panel in panels:
+            service.cancel(session_id, panel)
+        raise
+
+    def assemble(results):
+        timer = StageTimer("facet render")
+        timer.add("render panels", time.perf_counter() - start)
+        with timer.stage("assemble grid"):
+            png = facet_grid([panel_png for panel_png, _ in results], plan["ncols"])
+        # worker time over wall time is how many panels were drawn at once, on average
+        timer.count(panels=len(results), panel_seconds=round(sum(record["total"] for _, record in results), 4),
+                    rows=sum(record["counts"].get("rows", 0) for _, record in results), png_bytes=len(png))
+        return None, png, timer.record()
+
+    return gather(panels, assemble), panels
+
+DRAFT_MIN_ROWS = 200_000 # data with fewer rows renders quickly enough without a draft
+DRAFT_ROWS = 20_000 # rows sampled for the draft
+DRAFT_LEVELS = 40 # distinct values kept per numeric unibar in the draft
+DRAFT_DPI = 40
+
+def render_session_id() -> str:
+    """
+    Identifies the session to the render service, which takes turns between sessions.
+    """
+    if "render_session" not in st.session_state:
+        st.session_state.render_session = uuid.uuid4().hex
+    return st.session_state.render_session
+
+def _cache_render(cache_key, future):
+    # cache even if the job was superseded meanwhile - the user may toggle back to it
+    if not future.cancelled() and future.exception() is None:
+        render_cache.put(cache_key, future.result()[1])
+
+def cancel_render():
+    """
+    Cancels the session's pending render: dropped from the queue if it hasn't started,
+    left to finish (and be cached) if it has. Its result is never shown.
+    """
+    job = st.session_state.get("render_job")
+    if job is not None:
+        for future in [job["future"], job.get("draft")] + job.get("panels", []):
+            if future is not None:
+                get_render_service().cancel(render_session_id(), future)
+        st.session_state.render_job = None
+        st.session_state.pop("draft_buf", None)
 
 def plot(# General
             var,
@@ -44,45 +531,205 @@ def plot(# General
             # Other
             shape,
             same_scale,
-            violin_bw_method):
-    hammock = hammock_plot.Hammock(data_df=st.session_state.df)
-
-    # try:
-    ax = hammock.plot(
-        var=var,
-        weights=weights,
-        value_order=value_order,
-        numerical_var_levels=numerical_var_levels,
-        display_type=display_type,
-        missing=missing,
-        missing_placeholder=missing_placeholder,
-        label=label,
-        unibar=unibar,
-        hi_var=hi_var,
-        hi_value=hi_value,
-        hi_box=hi_box,
-        hi_missing=hi_missing,
-        colors=colors,
-        default_color=default_color,
-        uni_vfill=uni_vfill,
-        connector_fraction=connector_fraction,
-        connector_color=connector_color,
-        uni_hfill=uni_hfill,
-        label_options=label_options,
-        height=height,
-        width=width,
-        alpha=alpha,
-        min_bar_height=min_bar_height,
-        shape=shape,
-        same_scale=same_scale,
-        display_figure=True,
-        save_path=None,
-        violin_bw_method=violin_bw_method,
-    )
-    st.session_state.fig = ax.get_figure()
-    prep_data_for_download()
-    # except Exception as e:
-    #     st.error(str(e))
+            violin_bw_method,
+            binning=None,
+            large_n=False,
+            facet=None,
+            sample_rows=None):
+    """
+    Starts rendering a hammock plot of st.session_state.df in the background, replacing
+    any render of the session that is still pending. A plot that's in the render cache
+    is shown straight away, and if only style settings changed since the last render
+    its figure is restyled rather than drawn again. For large data, a quick low
+    resolution draft from a row sample is rendered first. With sample_rows, the plot is
+    of a weighted stratified sample of that many rows (see sample_data). binning bins or
+    caps unibars before they are plotted (see apply_binning), and large_n draws large
+    rugplots and violins from binned values (see thin_large_n). With facet =
+    {"column", "ncols"}, there is a panel per value of the column, rendered in parallel
+    and shown as one grid (see facet_plan).
+    Use collect_render() to pick up the result and render_position() for the number
+    of renders queued ahead of it. The arguments are kept with the plot's source as
+    "settings", for saving them as a batch_render spec.
+    """
+    # hash the arguments before hammock gets them - it fills in value_order and colors in place
+    plot_args = copy.deepcopy(dict(locals()))
+    del plot_args["sample_rows"]
+    settings = dict(plot_args, sample_rows=sample_rows) # as given, before sampling swaps the weights
+    timer = StageTimer("plot request")
+    with timer.stage("fingerprint data"):
+        data_key = data_fingerprint()
+    # workers load stored datasets from the shared store; anything else is sent over as it is
+    data = st.session_state.get("dataset_id") or st.session_state.df
+    rows = len(st.session_state.df)
+    sample = None
+    if sample_rows:
+        with timer.stage("sample"):
+            sampled, weight_col, sample = sample_data(plot_args, sample_rows)
+        if sample is not None:
+            # the sample is a function of the data, the plotted columns and its size
+            data, rows = sampled, len(sampled)
+            data_key = f"{data_key}:sample{sample_rows}"
+            plot_args["weights"] = weight_col
+    cache_key = (data_key, hash_plot_args(plot_args))
+    source = {"data_key": data_key, "args": plot_args, "data": data, "sample": sample, "settings": settings}
+    if facet:
+        with timer.stage("plan facets"):
+            if sample is not None:
+                source["facet_plan"] = facet_plan(data, plot_args)
+            else:
+                levels = facet_levels(get_profile(facet["column"]).unique_values)
+                source["facet_plan"] = facet_plan(st.session_state.df, plot_args, levels)
+    cancel_render()
+    png = render_cache.get(cache_key)
+    # plots kept by every session, for watching a long-running server's memory in the logs
+    timer.count(rows=rows, cache_hit=png is not None, figure_bytes=figure_budget.stats()["bytes"])
+    if png is not None:
+        st.session_state.figures = figure_budget.keep(render_session_id(), SessionFigures(png))
+        st.session_state.fig_source = source
+        log_record(timer.record())
+        return
+
+    service = get_render_service()
+    if facet:
+        # the panels are the parallel renders; no draft or restyle for them
+        panels = []
+        try:
+            future, panels = render_facets(service, render_session_id(), data, source["facet_plan"])
+        except RenderQueueFull as e:
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(functools.partial(_cache_render, cache_key))
+        st.session_state.render_job = {"future": future, "draft": None, "panels": panels, "source": source}
+        log_record(timer.record())
+        return
+
+    figures = st.session_state.get("figures")
+    fig = figures.fig_bytes if figures is not None else None
+    last = st.session_state.get("fig_source")
+    draft_task_args = None
+    if fig is not None and last["data_key"] == data_key and style_only_change(last["args"], plot_args):
+        # only colours, opacity or labels changed: restyle the last figure instead of laying it out again
+        task = (restyle_task, fig, last["args"], data, plot_args)
+    else:
+        task = (render_task, data, plot_args)
+        if rows >= DRAFT_MIN_ROWS:
+            # queued ahead of the exact render, so a sample of the data shows up first
+            draft_task_args = (draft_task, data, plot_args, DRAFT_ROWS, DRAFT_LEVELS, DRAFT_DPI)
+    draft = None
+    try:
+        if draft_task_args is not None:
+            draft = service.submit(render_session_id(), *draft_task_args)
+        future = service.submit(render_session_id(), *task)
+    except RenderQueueFull as e:
+        if draft is not None:
+            service.cancel(render_session_id(), draft)
+            draft = None
+        future = Future()
+        future.set_exception(e)
+    future.add_done_callback(functools.partial(_cache_render, cache_key))
+    st.session_state.render_job = {"future": future, "draft": draft, "source": source}
+    log_record(timer.record())
+
+def sample_data(plot_args, n):
+    """
+    Stratified sample of st.session_state.df for plot_args (see sampling.stratified_sample),
+    kept in session state until the data, the plotted columns or highlighting change.
+    Strata are the combinations of the unibars with few distinct values and the
+    highlight groups, so rare categories and every highlighted group are kept and their
+    bars are exact. Returns (sample, weight column, report).
+    """
+    var, hi_var, hi_value = plot_args["var"], plot_args["hi_var"], plot_args["hi_value"]
+    key = (st.session_state.get("data_version", 0), tuple(var), hi_var, json.dumps(hi_value),
+           plot_args["hi_missing"], plot_args["weights"], n)
+    cached = st.session_state.get("plot_sample")
+    if cached is None or cached[0] != key:
+        strata_columns = [col for col in var
+                          if get_profile(col).n_unique_exact and get_profile(col).n_unique <= MAX_STRATUM_LEVELS]
+        cached = (key, plot_sample(st.session_state.df, plot_args, n, strata_columns))
+        st.session_state.plot_sample = cached
+    return cached[1]
+
+def plot_sample(df: pd.DataFrame, plot_args, n, strata_columns):
+    """
+    Stratified sample of df for plot_args, with the combinations of strata_columns and
+    the highlight groups as strata (see sample_data). Returns (sample, weight column, report).
+    """
+    keys = [df[col] for col in strata_columns]
+    groups = highlight_groups(df, plot_args["hi_var"], plot_args["hi_value"], plot_args["hi_missing"], plot_args["missing_placeholder"])
+    if groups is not None:
+        keys.append(groups)
+    return stratified_sample(df, keys, plot_args["weights"], n)
+
+def collect_render():
+    """
+    Checks on the session's render job. Returns "idle" if there is none, "pending" while
+    it waits or runs, "done" once its PNG and pickled figure are in st.session_state.figures
+    (a figure_store.SessionFigures), or the exception it raised. While it's pending, a finished draft is put in st.session_state.draft_buf.
+    """
+    job = st.session_state.get("render_job")
+    if job is None:
+        return "idle"
+    if not job["future"].done():
+        draft = job.get("draft")
+        if draft is not None and draft.done() and "draft_buf" not in st.session_state:
+            if not draft.cancelled() and draft.exception() is None:
+                st.session_state.draft_buf = io.BytesIO(draft.result())
+        return "pending"
+    st.session_state.render_job = None
+    st.session_state.pop("draft_buf", None)
+    try:
+        fig, png, record = job["future"].result()
+    except Exception as e:
+        return e
+    log_record(record)
+    # the figure is pickled; the live one was closed in the render worker
+    st.session_state.figures = figure_budget.keep(render_session_id(), SessionFigures(png, fig))
+    st.session_state.fig_source = job["source"]
+    return "done"
+
+def clear_plot():
+    """
+    Cancels the session's render and drops its plot.
+    """
+    cancel_render()
+    figure_budget.forget(render_session_id())
+    st.session_state.pop("figures", None)
+
+def plot_export(fmt, dpi=None):
+    """
+    Download button data callable for the plot on screen saved as fmt (at dpi for PNG).
+    The file is made in a render worker on the first download and kept with the plot
+    (within the figure budget) until the next render.
+    """
+    source = st.session_state.fig_source
+    figures = st.session_state.figures
+    # the callable runs outside the script run, so take what it needs from session state now
+    service, session_id = get_render_service(), render_session_id()
+    if "facet_plan" in source:
+        # faceted plots are a grid image, so PNG only
+        make = lambda: render_facets(service, session_id, source["data"], source["facet_plan"], dpi)[0].result()[1]
+    else:
+        task = (export_task, figures.fig_bytes, source["data"], source["args"], fmt, dpi)
+        make = lambda: service.submit(session_id, *task).result()
+    build = deferred(figures.exports, (fmt, dpi), make)
+
+    def export():
+        data = build()
+        figure_budget.enforce(figures) # the new file counts towards the budgets
+        return data
+    return export
+
+def render_position():
+    """
+    Number of renders from any session that will start before this session's, or None
+    if it isn't waiting for a worker.
+    """
+    job = st.session_state.get("render_job")
+    if job is None:
+        return None
+    # a faceted plot waits until its first panel starts
+    future = (job.get("panels") or [job["future"]])[0]
+    return get_render_service().position(render_session_id(), future)
 
 class Defaults:
     HEIGHT = 10.0
@@ -135,51 +782,204 @@ def clean_expression(expr: str) -> str:
     return expr.strip()
 
 
-def is_in_range(x: float, expr: str) -> bool:
+_COMPARE_OPS = {
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+
+_BINARY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+    ast.Pow: np.power,
+}
+
+def _compile_node(node):
     """
-    Evaluates whether the given x satisfies the cleaned expression.
-    Only 'x' is available inside the eval environment.
+    Turns one node of a parsed range expression into a function of the numpy array x.
+    Only x, numeric constants, arithmetic, comparisons and and/or/not are allowed.
     """
-    expr = clean_expression(expr)
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body)
+    if isinstance(node, ast.Name) and node.id == "x":
+        return lambda x: x
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, bool)):
+        value = node.value
+        return lambda x: value
+    if isinstance(node, ast.BoolOp):
+        operands = [_compile_node(value) for value in node.values]
+        reduce = np.logical_and.reduce if isinstance(node.op, ast.And) else np.logical_or.reduce
+        return lambda x: reduce([np.broadcast_to(operand(x), np.shape(x)) for operand in operands])
+    if isinstance(node, ast.UnaryOp):
+        operand = _compile_node(node.operand)
+        if isinstance(node.op, ast.Not):
+            return lambda x: np.logical_not(operand(x))
+        if isinstance(node.op, ast.USub):
+            return lambda x: np.negative(operand(x))
+        if isinstance(node.op, ast.UAdd):
+            return operand
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+        op = _BINARY_OPS[type(node.op)]
+        left, right = _compile_node(node.left), _compile_node(node.right)
+        return lambda x: op(left(x), right(x))
+    if isinstance(node, ast.Compare) and all(type(op) in _COMPARE_OPS for op in node.ops):
+        # chained comparisons (1 < x < 5) are the conjunction of each pair
+        terms = [_compile_node(node.left)] + [_compile_node(c) for c in node.comparators]
+        ops = [_COMPARE_OPS[type(op)] for op in node.ops]
+
+        def compare(x):
+            values = [term(x) for term in terms]
+            result = ops[0](values[0], values[1])
+            for i in range(1, len(ops)):
+                result = np.logical_and(result, ops[i](values[i], values[i + 1]))
+            return result
+        return compare
+    raise ValueError(f"Unsupported syntax in expression: {ast.dump(node)}")
+
+@functools.lru_cache(maxsize=256)
+def compile_range_expression(expr: str):
+    """
+    Parses a range expression (e.g. "x>1 and (x>5 or x<4)") once and returns a function
+    mapping a numpy array of values to a boolean mask. Raises ValueError if the
+    expression is not a valid range expression.
+    """
+    cleaned = clean_expression(expr)
     try:
-        return eval(expr, {"__builtins__": {}}, {"x": x})
-    except Exception as e:
-        raise ValueError(f"Invalid expression: '{expr}'") from e
+        fn = _compile_node(ast.parse(cleaned, mode="eval"))
+    except (SyntaxError, ValueError) as e:
+        raise ValueError(f"Invalid expression: '{cleaned}'") from e
+
+    def mask(x):
+        x = np.asarray(x)
+        with np.errstate(all="ignore"):
+            return np.broadcast_to(fn(x), x.shape).astype(bool)
+    return mask
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(expr: str):
+    """
+    Compiled regex for a highlight expression, or None if it isn't a valid regex.
+    """
+    try:
+        return re.compile(expr)
+    except re.error:
+        return None
+
+def is_in_range(x: float, expr: str) -> bool:
+    """
+    Evaluates whether the given x satisfies the range expression.
+    """
+    return bool(compile_range_expression(expr)(x))
 
 def validate_expression(expr: str) -> bool:
     """
-    Validates whether an expression string can be parsed and evaluated safely.
+    Validates whether an expression string can be parsed safely.
     Returns True if it's either:
       - A valid numeric range expression for `is_in_range`
       - A valid regex pattern
     """
-    # First, check if it can be evaluated as a numeric range
     try:
-        _ = is_in_range(0, expr)
+        compile_range_expression(expr)
         return True
-    except Exception:
+    except ValueError:
         pass
+    return compile_pattern(expr) is not None
+
+def highlight_mask(column: pd.Series, expr: str) -> np.ndarray:
+    """
+    Boolean mask of the rows of column selected by a regex/range highlight expression,
+    following hammock_plot's rules: string values are searched with the expression as a
+    regex, and values that are (or parse as) numbers are tested with it as a range
+    expression. Missing values are never selected.
 
-    # Next, check if it's a valid regex
+    The expression is evaluated once over the distinct values, not once per row.
+    """
     try:
-        re.compile(expr)
-        return True
-    except re.error:
-        return False
+        in_range = compile_range_expression(expr)
+    except ValueError:
+        in_range = None
+    pattern = compile_pattern(expr)
 
-def get_uni_type(uni):
-    df = st.session_state.df
-    temp = df[uni].dropna()
-    dtype = temp.dtype
+    if pd.api.types.is_numeric_dtype(column.dtype) and not isinstance(column.dtype, pd.CategoricalDtype):
+        if in_range is None:
+            return np.zeros(len(column), dtype=bool)
+        values = column.to_numpy(dtype="float64", na_value=np.nan)
+        return in_range(values) & ~np.isnan(values)
 
-    if pd.api.types.is_integer_dtype(dtype):
-        return "numeric"
-    elif pd.api.types.is_float_dtype(dtype):
-        return "numeric"
-    elif pd.api.types.is_categorical_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
-        return "categorical"
-    else:
-        raise RuntimeError("Invalid dtype detected - logic error in code. dtype: ", dtype)
+    codes, uniques = pd.factorize(column)
+    uniques = pd.Series(uniques, dtype=object)
+    selected = np.zeros(len(uniques), dtype=bool)
+    is_str = uniques.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+    if pattern is not None and is_str.any():
+        with warnings.catch_warnings():
+            # pandas warns about capture groups, which don't matter for a match test
+            warnings.simplefilter("ignore", UserWarning)
+            selected[is_str] = uniques[is_str].str.contains(pattern, regex=True).to_numpy(dtype=bool)
+    if in_range is not None:
+        numbers = pd.to_numeric(uniques, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+        selected |= in_range(numbers) & ~np.isnan(numbers)
+    # factorize marks missing values with code -1
+    return np.where(codes >= 0, selected[codes], False)
+
+HIGHLIGHT_COLUMN = "hammock_highlight"
+HIGHLIGHT_LABEL = "highlighted"
+
+def resolve_highlight_expression(df: pd.DataFrame, hi_var, hi_value, hi_missing, missing_placeholder):
+    """
+    Evaluates a regex/range highlight expression over the whole hi_var column with
+    `highlight_mask` and swaps hi_var for a synthetic column labelling the selected rows,
+    so hammock_plot colours rows with a label lookup instead of evaluating the expression
+    row by row. Returns (df, hi_var, hi_value).
+    """
+    if not (hi_var and isinstance(hi_value, str) and hi_value):
+        return df, hi_var, hi_value
+
+    column = df[hi_var]
+    mask = highlight_mask(column, hi_value)
+    labels = np.where(mask, HIGHLIGHT_LABEL, "")
+    if hi_missing:
+        labels = np.where(column.isna().to_numpy(), missing_placeholder, labels)
+
+    highlight_col = HIGHLIGHT_COLUMN
+    while highlight_col in df.columns:
+        highlight_col = "_" + highlight_col
+    df = df.assign(**{highlight_col: labels})
+
+    if mask.any():
+        return df, highlight_col, [HIGHLIGHT_LABEL]
+    if hi_missing:
+        return df, highlight_col, None
+    # nothing matched: the plot is the same as an unhighlighted one
+    return df, None, None
+
+def highlight_groups(df: pd.DataFrame, hi_var, hi_value, hi_missing, missing_placeholder):
+    """
+    The highlight colour group of each row (as an integer code), or None if nothing is
+    highlighted. Label lists are matched on the formatted labels they were picked from.
+    """
+    df, hi_var, hi_value = resolve_highlight_expression(df, hi_var, hi_value, hi_missing, missing_placeholder)
+    if hi_var is None:
+        return None
+    codes, uniques = pd.factorize(df[hi_var])
+    labels = get_formatted_values(pd.Series(uniques)) if len(uniques) else []
+    hi_value = hi_value or []
+    groups = [hi_value.index(label) if label in hi_value else
+              len(hi_value) if hi_missing and label == missing_placeholder else -1 for label in labels]
+    # factorize codes missing values as -1, which picks the last group
+    return np.array(groups + [len(hi_value) if hi_missing else -2])[codes]
+
+def get_uni_type(uni):
+    profile = get_profile(uni)
+    if profile.kind is None:
+        raise RuntimeError("Invalid dtype detected - logic error in code. dtype: ", profile.dtype)
+    return profile.kind
 
 def get_formatted_label(datatype, value):
     # if the label is a string
@@ -207,5 +1007,62 @@ def get_formatted_values(raw_values):
             dtype = np.floating
     elif pd.api.types.is_categorical_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
         dtype = np.str_
-    
-    return [get_formatted_label(dtype, value) for value in non_na]
\ No newline at end of file
+
+    if dtype == np.str_:
+        return list(non_na)
+    if dtype not in (np.integer, np.floating):
+        return [get_formatted_label(dtype, value) for value in non_na]
+
+    # same labels as get_formatted_label, formatted in bulk
+    values = np.asarray(non_na, dtype="float64")
+    scientific = (np.abs(values) >= 1000000) | ((0 < np.abs(values)) & (np.abs(values) < 0.01))
+    labels = np.empty(len(values), dtype=object)
+    labels[scientific] = np.char.mod("%.2e", values[scientific]).tolist()
+    rest = values[~scientific]
+    if dtype == np.integer:
+        labels[~scientific] = rest.astype(np.int64).astype(str).tolist()
+    else:
+        labels[~scientific] = np.char.mod("%.2f", rest).tolist()
+    return labels.tolist()
+
+OPTIONS_PAGE_SIZE = 100
+MAX_SEARCH_MATCHES = 5000
+
+def paged_multiselect(label, col, key, help=None):
+    """
+    Multiselect over the formatted values of a column. If the column profile kept its
+    unique values, this is a plain multiselect. Otherwise the options are paged - the
+    most frequent values by default, or the values matching a search, found by scanning
+    the column on demand - and values picked on other pages stay selected.
+    """
+    profile = get_profile(col)
+    if profile.unique_values is not None:
+        return st.multiselect(label=label, options=get_formatted_values(profile.unique_values), help=help, key=key)
+
+    search = st.text_input(label=f"Search values ({profile.describe_uniques()})", key=f"{key}_search",
+                           help="Only the most frequent values are listed until you search.")
+    if search:
+        search_key = f"{key}_matches"
+        cached = st.session_state.get(search_key)
+        if cached is None or cached[0] != (st.session_state.get("data_version", 0), search):
+            column = st.session_state.df[col].dropna()
+            matches = column[column.astype(str).str.contains(search, regex=False)].unique()[:MAX_SEARCH_MATCHES]
+            cached = ((st.session_state.get("data_version", 0), search), get_formatted_values(matches))
+            st.session_state[search_key] = cached
+        options = cached[1]
+    else:
+        options = get_formatted_values(profile.top_values.index.to_numpy())
+
+    num_pages = max(1, -(-len(options) // OPTIONS_PAGE_SIZE))
+    page = st.number_input(label=f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1, step=1, key=f"{key}_page")
+    page_options = options[(page - 1) * OPTIONS_PAGE_SIZE:page * OPTIONS_PAGE_SIZE]
+
+    selected_key = f"{key}_selected"
+    selected = st.session_state.get(selected_key, [])
+    widget_key = f"{key}_{page}_{search}"
+    # selections from other pages stay in the options so they remain selected here
+    page_options = page_options + [value for value in selected if value not in page_options]
+    selected = st.multiselect(label=label, options=page_options, help=help, key=widget_key,
+                              default=None if widget_key in st.session_state else selected)
+    st.session_state[selected_key] = selected
+    return selected
\ No newline at end of file